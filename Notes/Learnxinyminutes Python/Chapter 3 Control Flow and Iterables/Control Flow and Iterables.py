@@ -3,6 +3,22 @@
     Control Flow and Iterables
 """
 
+# The "Benchmark" parts further down write big files (hundreds of MB for a few of them) and take minutes all together,
+# so running these notes top to bottom skips them. To run them too:
+#     RUN_BENCHMARKS=1 python "Control Flow and Iterables.py"
+# Everything they write goes in one temp folder (the path gets printed), never next to these notes
+import os
+import tempfile
+
+RUN_BENCHMARKS = os.environ.get("RUN_BENCHMARKS") == "1"
+BENCH_DIR = tempfile.mkdtemp(prefix="notes_bench_") if RUN_BENCHMARKS else None
+if RUN_BENCHMARKS:
+    print("Benchmark files go in", BENCH_DIR)
+
+def bench_path(name):
+    return os.path.join(BENCH_DIR, name)
+
+
 # Making a variable for example use
 some_var = 5
 
@@ -210,6 +226,217 @@ with open("data.json") as f:
     data = json.load(f)
 
 
+# JSON, streaming
+# json.load(f) reads the WHOLE file and builds the WHOLE object before we get to touch any of it
+# A 2GB event dump turns into way more than 2GB of dicts/lists/strings in memory (Python objects are fat)
+#
+# Two ways around it:
+#   NDJSON (newline delimited JSON) -> one JSON object per line. Read a line, json.loads it, yield it, forget it
+#       {"id": 1, "event": "login"}
+#       {"id": 2, "event": "logout"}
+#   One giant [ ... ] array -> can't go line by line, so read a chunk at a time and let
+#       JSONDecoder.raw_decode() pull out one complete element at a time from the text we have so far
+#
+# Both are generators, so memory is about one record (plus a read buffer) no matter how big the file is
+# The writer batches lines up and does one big f.write() every so often instead of one per record
+
+import json
+import time
+import tracemalloc
+
+def read_ndjson(path):
+    loads = json.loads
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():        # Skip blank lines, they show up at the end of files a lot
+                yield loads(line)
+
+
+class NDJSONWriter:
+    def __init__(self, path, buffer_records=10_000):
+        self.path = path
+        self.buffer_records = buffer_records
+        self.buffer = []
+        self.encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode   # No spaces = smaller file
+
+    def __enter__(self):
+        self.f = open(self.path, "w", encoding="utf-8")
+        return self
+
+    def write(self, record):
+        self.buffer.append(self.encode(record))
+        if len(self.buffer) >= self.buffer_records:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.buffer.append("")      # So the join ends with a newline too
+            self.f.write("\n".join(self.buffer))
+            self.buffer = []
+
+    def __exit__(self, *exc):
+        self.flush()
+        self.f.close()
+
+
+def iter_json_array(path, chunk_size=1024 * 1024):
+    # Yields each element of a file shaped like [ {...}, {...}, ... ] without loading the whole thing
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = ""
+        position = 0
+        dropped = 0             # Characters already thrown away from the front, so errors can say where they are
+        at_eof = False
+        expect = "["            # What has to come next: "[" to start, "value" after [ or a comma, "," after a value,
+                                # "end" after the closing ] (only whitespace is allowed from there on)
+        started = False         # Seen at least one element (so "]" right after a comma is an error, [] is fine)
+        while True:
+            # Skip whitespace. Running out of buffer just means read more, however long the whitespace goes on
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position < len(buffer):
+                char = buffer[position]
+                if expect == "end":
+                    raise ValueError(f"{path}: extra data after the closing ] at character {dropped + position}")
+                if expect == "[":
+                    if char != "[":
+                        raise ValueError(f"{path} is not a JSON array")
+                    position += 1
+                    expect = "value"
+                    continue
+                if expect == ",":
+                    if char == "]":
+                        position += 1
+                        expect = "end"
+                        continue
+                    if char != ",":
+                        raise ValueError(f"{path}: expected , or ] at character {dropped + position}, found {char!r}")
+                    position += 1
+                    expect = "value"
+                    continue
+                if char == "]":
+                    if started:
+                        raise ValueError(f"{path}: trailing comma before ] at character {dropped + position}")
+                    position += 1
+                    expect = "end"
+                    continue
+                if char == ",":
+                    raise ValueError(f"{path}: expected a value at character {dropped + position}, found ','")
+                try:
+                    obj, end = decoder.raw_decode(buffer, position)
+                    # A number right at the end of the buffer might be cut off ("12" of "123", "1" of "1.5")
+                    # A real element is always followed by whitespace, a comma or the closing ], so check for that
+                    complete = at_eof or (end < len(buffer) and buffer[end] in " \t\r\n,]")
+                except json.JSONDecodeError:
+                    if at_eof:
+                        raise
+                    complete = False
+                if complete:
+                    yield obj
+                    position = end
+                    expect = ","
+                    started = True
+                    continue
+            elif at_eof:
+                if expect == "end":
+                    return
+                raise ValueError(f"{path} ended before the closing ]" if expect != "[" else f"{path} is not a JSON array")
+            # Need more text. Drop what we've already used so the buffer doesn't grow forever
+            chunk = f.read(chunk_size)
+            at_eof = not chunk
+            dropped += position
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+events = [{"id": 1, "event": "login", "user": "Alice"}, {"id": 2, "event": "logout", "user": "Alice"}]
+
+with NDJSONWriter("events.ndjson") as writer:
+    for event in events:
+        writer.write(event)
+
+for event in read_ndjson("events.ndjson"):
+    print(event)
+
+with open("events.json", "w") as f:
+    json.dump(events, f)
+
+for event in iter_json_array("events.json"):
+    print(event["id"], event["event"])
+
+# Prints
+"""
+{'id': 1, 'event': 'login', 'user': 'Alice'}
+{'id': 2, 'event': 'logout', 'user': 'Alice'}
+1 login
+2 logout
+"""
+
+# Anything but whitespace after the closing ] is an error, same as json.load's "Extra data"
+with tempfile.TemporaryDirectory() as folder:
+    for text in ("[]x", "[1]]", "[1, 2] \n"):
+        path = os.path.join(folder, "events.json")
+        with open(path, "w") as f:
+            f.write(text)
+        try:
+            print(repr(text), list(iter_json_array(path)))
+        except ValueError as error:
+            print(repr(text), "ValueError:", str(error).replace(path, "events.json"))
+
+# Prints
+"""
+'[]x' ValueError: events.json: extra data after the closing ] at character 2
+'[1]]' ValueError: events.json: extra data after the closing ] at character 3
+'[1, 2] \n' [1, 2]
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 500k events (~40MB) as one JSON array and as NDJSON. Count logins.
+    # Peak memory scales with the file for json.load, and stays flat for the streaming readers,
+    # so a 2GB file is the same picture, just a lot slower to run
+    def big_events():
+        for i in range(500_000):
+            yield {"id": i, "event": "login" if i % 3 else "logout", "user": f"user{i % 1000}", "tags": ["emr", "web"], "ms": i % 997}
+
+    with open(bench_path("events_big.json"), "w") as f:
+        json.dump(list(big_events()), f)
+
+    with NDJSONWriter(bench_path("events_big.ndjson")) as writer:
+        for event in big_events():
+            writer.write(event)
+
+    def with_json_load():
+        with open(bench_path("events_big.json")) as f:
+            return sum(1 for event in json.load(f) if event["event"] == "login")
+
+    def with_iter_json_array():
+        return sum(1 for event in iter_json_array(bench_path("events_big.json")) if event["event"] == "login")
+
+    def with_read_ndjson():
+        return sum(1 for event in read_ndjson(bench_path("events_big.ndjson")) if event["event"] == "login")
+
+    for label, func in [("json.load", with_json_load), ("iter_json_array", with_iter_json_array), ("read_ndjson", with_read_ndjson)]:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<18}{500_000 / elapsed:>12,.0f} records/s   peak {peak / 1e6:8.1f} MB")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    json.load              291,882 records/s   peak    315.6 MB
+    iter_json_array        525,290 records/s   peak      5.3 MB
+    read_ndjson            463,317 records/s   peak      0.0 MB
+    """
+    # A 40MB file took 315MB as Python objects. The streaming readers hold one record + the read buffer (~1MB chunks
+    # of text for iter_json_array), and they're faster too since nothing big ever has to be allocated
+
+# Great for event/audit log dumps, API exports, anything that's "a huge list of the same kind of record"
+
 # CSV
 # Good for....CSV's
 import csv
@@ -238,6 +465,248 @@ with open("people.csv") as f:
     for row in reader:
         print(row["name"], row["dob"])
 
+# CSV, column by column
+# DictReader is great for 3 rows. For a few million rows it's doing a lot of work we throw away:
+#   a brand new dict for EVERY row, hashing "name", "dob", "address" again every time
+#   everything stays a string, so "30" takes ~50 bytes instead of 8 and we convert it later anyway
+#
+# A columnar reader flips it around. Instead of a list of rows, keep one container per column:
+#   name    -> ["Alice", "Bob", ...]          (strings interned, so 1000 "Springfield"s are ONE object)
+#   age     -> array('q', [30, 81, ...])      (array = packed C integers, 8 bytes each, like a C int64_t[])
+#   dob     -> array('l', [726147, ...])      (dates stored as day numbers, turned back into date objects on read)
+# Rows come out in fixed size batches so memory stays flat no matter how big the file is
+#
+# The trick that makes it fast: read a batch of raw rows with csv.reader, then zip(*rows) flips them into columns,
+# and map(int, column) converts a whole column in C instead of one Python call per value
+
+import csv
+import gc
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+from datetime import date
+from functools import lru_cache
+
+@lru_cache(maxsize=100_000)
+def parse_date(text):
+    # "02-14-1990" (MM-DD-YYYY, like people.csv). Slicing is ~10x faster than strptime,
+    # and birthdays repeat a LOT, so most rows don't even get that far, they're a cache hit
+    return date(int(text[6:10]), int(text[0:2]), int(text[3:5])).toordinal()
+
+# How each schema type gets stored: (converter, make the column container)
+COLUMN_TYPES = {
+    int: (int, lambda values: array("q", values)),
+    float: (float, lambda values: array("d", values)),
+    date: (parse_date, lambda values: array("l", values)),
+    str: (sys.intern, list),
+}
+
+
+class Row:
+    # Looks like a DictReader row (row["name"]), but it's just a pointer into the batch, nothing gets copied
+    __slots__ = ("batch", "index")
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __getitem__(self, name):
+        value = self.batch.columns[name][self.index]
+        return date.fromordinal(value) if self.batch.schema[name] is date else value
+
+    def __repr__(self):
+        return f"Row({ {name: self[name] for name in self.batch.columns} })"
+
+
+class ColumnBatch:
+    def __init__(self, schema, columns):
+        self.schema = schema
+        self.columns = columns      # name -> array or list
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def rows(self):
+        for i in range(len(self)):
+            yield Row(self, i)
+
+
+def line_breaks(row):
+    # A quoted field can span lines, so one row can take up more than one line of the file
+    return sum(field.count("\n") + field.count("\r") - field.count("\r\n") for field in row)
+
+def check_rows(rows, width, first_line, path):
+    # The slow path, only when a batch has a row of the wrong length. Blank lines get dropped (DictReader skips
+    # them too), anything else short or long is an error, with the line it's on
+    line = first_line
+    kept = []
+    for row in rows:
+        if row:
+            if len(row) != width:
+                raise ValueError(f"{path} line {line}: expected {width} fields, got {len(row)}")
+            kept.append(row)
+        line += 1 + line_breaks(row)
+    return kept
+
+
+def read_columns(path, schema, batch_size=65_536):
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        width = len(header)
+        positions = [header.index(name) for name in schema]     # Find each column once, not once per row
+        while True:
+            first_line = reader.line_num + 1
+            # Python's garbage collector keeps scanning all these new row lists looking for reference cycles
+            # There aren't any (they're just lists of strings), so pause it while building the batch
+            gc_was_on = gc.isenabled()
+            gc.disable()
+            try:
+                rows = list(itertools.islice(reader, batch_size))
+                if not rows:
+                    return
+                # zip() stops at the shortest row, so one short (or blank) row would quietly cut every column short
+                # map(len) + set is C speed, the row by row check only runs when something's actually off
+                if set(map(len, rows)) != {width}:
+                    rows = check_rows(rows, width, first_line, path)
+                raw_columns = list(zip(*rows))      # Flip rows -> columns
+            finally:
+                if gc_was_on:
+                    gc.enable()
+            if not rows:
+                continue        # The whole batch was blank lines
+            columns = {}
+            for name, position in zip(schema, positions):
+                convert, container = COLUMN_TYPES[schema[name]]
+                columns[name] = container(map(convert, raw_columns[position]))
+            yield ColumnBatch(schema, columns)
+
+
+schema = {"name": str, "dob": date, "address": str}
+
+for batch in read_columns("people.csv", schema):
+    print(batch["name"], len(batch))
+    for row in batch.rows():
+        print(row["name"], row["dob"])
+
+# Prints
+"""
+['Alice', 'Bob'] 2
+Alice 1990-02-14
+Bob 1943-07-16
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 500k rows, read everything and keep it
+    with open(bench_path("people_big.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "dob", "address", "age"])
+        names = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank"]
+        streets = ["Main Street", "Side Road", "Oak Avenue", "Elm Court"]
+        for i in range(500_000):
+            writer.writerow([random.choice(names), f"{random.randint(1, 12):02}-{random.randint(1, 28):02}-{random.randint(1930, 2020)}",
+                             f"{random.randint(1, 999)} {random.choice(streets)}", random.randint(0, 100)])
+
+    big_schema = {"name": str, "dob": date, "address": str, "age": int}
+
+    def with_dictreader():
+        with open(bench_path("people_big.csv"), newline="") as f:
+            return list(csv.DictReader(f))
+
+    def with_columns():
+        return list(read_columns(bench_path("people_big.csv"), big_schema))
+
+    for label, func in [("DictReader", with_dictreader), ("read_columns", with_columns)]:
+        best = None
+        for _ in range(3):      # Best of 3, the first run also pays for the OS reading the file off disk
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            del result
+        tracemalloc.start()     # Separate run just for memory, tracemalloc slows everything down
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del result
+        print(f"{label:<14}{500_000 / best:>12,.0f} rows/s   peak {peak / 1e6:7.1f} MB")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    DictReader         398,262 rows/s   peak   206.6 MB
+    read_columns       421,286 rows/s   peak    57.1 MB
+    """
+    # tracemalloc's peak is what Python allocated, close enough to RSS for comparing the two
+    # Speed is about a tie because csv.reader itself (C code) is most of the time either way,
+    # the real win is ~3.5x less memory AND the ages/dates are already numbers
+
+# Great for big exports, reporting jobs, anything that does math on whole columns (sum of ages, count by date)
+
+# CSV on every core
+# csv.reader only ever uses one CPU core. A 10GB file on an 8 core machine leaves 7 cores doing nothing
+# Plan:
+#   1) Cut the file into byte ranges (say 64MB each)
+#   2) Hand each range to a separate process (ProcessPoolExecutor) which parses just its slice
+#   3) Stream the results back, either in file order or as soon as each one finishes
+#
+# Processes, not threads: the GIL only lets one thread run Python at a time, so threads wouldn't help CPU bound parsing
+#
+# The tricky part is where to cut. A cut in the middle of a row is obviously bad, and "just cut at the next newline"
+# isn't good enough either, because a quoted field can contain newlines:
+#     Alice,02-14-1990,"123 Main Street
+#     Apt 4"
+# A newline is only a real end of row if we're NOT inside quotes. Inside/outside quotes = odd/even number of " so far
+# (an escaped "" adds 2, so it doesn't change odd/even). bytes.count(b'"') is C speed, so one quick pass over the
+# file tracking that count is enough to find safe cut points
+# That only holds for RFC 4180 style CSV (what csv.writer writes): every " opens or closes a quoted field, or is
+# doubled inside one. A bare " inside an unquoted field (Height,5'10",...) flips odd/even for the rest of the file
+# and every later cut lands in the middle of a row. csv.reader copes with those files, so for them stick to it
+#
+# Backpressure: only keep a few chunks in flight at once. If the caller is slow consuming results, we stop
+# submitting new chunks instead of piling finished results up in memory
+#
+# The code for this one is in parallel_csv.py, next to these notes, not in this file. On Windows and macOS every
+# worker process starts by running the main script again from the top. For this file that's every example and
+# benchmark in it, once per worker, some of them rewriting files while the parent is still splitting them up.
+# An if __name__ == "__main__" guard around just this section doesn't stop that. A small module where the top level
+# is only function definitions does
+#
+#     python parallel_csv.py        runs the example + the benchmark
+#
+# From a script of our own (its top level code needs the same __main__ guard):
+#     from parallel_csv import parallel_csv, count_and_sum_ages
+#
+#     if __name__ == "__main__":
+#         for rows, ages in parallel_csv("claims.csv", count_and_sum_ages, ordered=False):
+#             ...
+#
+# parallel_csv(path, func=None, workers=None, chunk_bytes=64MB, ordered=True, max_pending=None, encoding="utf-8")
+#   func gets a list of rows and runs IN THE WORKER. Reduce there (count, sum, filter) and only the small
+#   result comes back. Sending millions of rows back to the parent would cost more than parsing them
+#   func has to be a normal top level function in a module, worker processes receive it by pickling its name
+#   encoding has to keep " and newline as plain ASCII bytes (utf-8, latin-1, cp1252 are fine, UTF-16 isn't)
+#
+# What python parallel_csv.py prints (numbers from a 1 core box, so this only shows the overhead, not the speedup)
+"""
+152 chunks, same rows as csv.reader: True
+csv.reader, 1 core          761,223 rows/s
+parallel, 1 workers        681,028 rows/s
+parallel, 2 workers        663,624 rows/s
+parallel, 4 workers        622,651 rows/s
+"""
+# With 1 core, extra workers just take turns and the pickling/process startup is pure cost
+# Each worker is independent (own process, own slice of the file, tiny result), so on an N core machine
+# it's close to N times the 1 worker number until the disk can't keep up
+
+# Great for nightly extracts, claim files, anything big enough that the CSV parsing itself is the bottleneck
+
 # XML
 # XML requires a parser
 # This one is funky, will have to come back to it. It's not a bad code problem, it's just how XML works. Will need practice.
@@ -261,6 +730,297 @@ for child in root:
     print(child.tag, child.text)
 
 
+# XML, streaming
+# ET.parse() builds the ENTIRE tree before we see the first element. Every tag becomes an Element object
+# with its own dict of attributes, and Element objects are big. A few GB of claims XML won't fit
+#
+# ET.iterparse() hands us elements as the parser reaches them instead:
+#   "start" event -> the parser just saw <person ...>
+#   "end" event   -> the parser just saw </person>, so the element and everything inside it is complete
+# On "end" of each record we turn it into a plain dict, yield it, then DELETE it from the tree
+# Without that last step iterparse still builds the whole tree in the background, just slower
+#
+# record_path = the path of tags down to one record, ex. "people/person" or "claims/claim"
+
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+class XMLStats:
+    def __init__(self):
+        self.records = 0
+        self.elements = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        rate = self.records / self.seconds if self.seconds else 0
+        return f"XMLStats(records={self.records}, elements={self.elements}, seconds={self.seconds:.2f}, records_per_sec={rate:,.0f})"
+
+
+def element_to_dict(elem):
+    # <person name="Alice"><dob>1990-02-14</dob></person> -> {"name": "Alice", "dob": "1990-02-14"}
+    # A tag that shows up more than once (two <line>s on a claim) becomes a list, in document order
+    record = dict(elem.attrib)
+    repeated = set()
+    for child in elem:
+        # Plain <tag>text</tag> becomes just the text, anything with attributes or children becomes a dict too
+        value = child.text if len(child) == 0 and not child.attrib else element_to_dict(child)
+        if child.tag not in record:
+            record[child.tag] = value
+        elif child.tag in repeated:
+            record[child.tag].append(value)
+        else:
+            record[child.tag] = [record[child.tag], value]
+            repeated.add(child.tag)
+    text = (elem.text or "").strip()
+    if text:
+        record["text"] = text
+    return record
+
+
+def iter_xml_records(path, record_path, stats=None):
+    target = record_path.split("/")
+    depth = len(target)
+    stats = stats if stats is not None else XMLStats()
+    start = time.perf_counter()
+    stack = []      # Elements we're currently inside of, root first
+    try:
+        for event, elem in ET.iterparse(path, events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                continue
+            stats.elements += 1
+            if len(stack) == depth and elem.tag == target[-1] and [e.tag for e in stack] == target:
+                stats.records += 1
+                yield element_to_dict(elem)
+                # Throw away this record AND any siblings already done, so the parent never piles up children
+                if len(stack) > 1:
+                    del stack[-2][:]
+                else:
+                    elem.clear()        # The record is the root itself, there's no parent to empty
+            stack.pop()
+    finally:
+        stats.seconds += time.perf_counter() - start
+
+
+for person in iter_xml_records("people.xml", "people/person"):
+    print(person)
+
+# Prints
+"""
+{'name': 'Alice'}
+{'name': 'Bob'}
+"""
+
+claim = ET.fromstring('<claim id="C1"><dx>E11.9</dx><dx>I10</dx><line code="99213" amount="120.00"/>'
+                      '<line code="80053" amount="45.00"/></claim>')
+print(element_to_dict(claim))
+
+# Prints
+"""
+{'id': 'C1', 'dx': ['E11.9', 'I10'], 'line': [{'code': '99213', 'amount': '120.00'}, {'code': '80053', 'amount': '45.00'}]}
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 300k people (~45MB), each with a few children. ET.parse + loop vs. iter_xml_records
+    # A 1GB file is the same picture: ET.parse's memory grows with the file, iter_xml_records' doesn't
+    with open(bench_path("people_big.xml"), "w") as f:
+        f.write("<people>\n")
+        for i in range(300_000):
+            f.write(f'  <person id="{i}" name="Person {i}"><dob>02-14-1990</dob><address>{i} Main Street</address>'
+                    f'<claim code="A{i % 50}" amount="{i % 500}.00"/></person>\n')
+        f.write("</people>\n")
+
+    def with_et_parse():
+        root = ET.parse(bench_path("people_big.xml")).getroot()
+        return sum(1 for person in root.iter("person") if person.find("claim").get("code") == "A7")
+
+    def with_iter_xml_records():
+        return sum(1 for person in iter_xml_records(bench_path("people_big.xml"), "people/person") if person["claim"]["code"] == "A7")
+
+    for label, func in [("ET.parse", with_et_parse), ("iter_xml_records", with_iter_xml_records)]:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<18}{300_000 / elapsed:>10,.0f} records/s   peak {peak / 1e6:7.1f} MB")
+
+    stats = XMLStats()
+    for person in iter_xml_records(bench_path("people_big.xml"), "people/person", stats):
+        pass
+    print(stats)
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    ET.parse              88,824 records/s   peak   379.5 MB
+    iter_xml_records     106,654 records/s   peak     0.2 MB
+    XMLStats(records=300000, elements=1200001, seconds=2.28, records_per_sec=131,334)
+    """
+    # 43MB of XML -> 380MB as a tree. Streaming stays at a couple hundred KB however long the file gets
+    # (stats.seconds is wall time from first to last record, so it includes whatever the loop body does)
+
+# Great for HL7/claims XML, big vendor exports, anything where the file is just a long list of the same record
+
+# XML, streaming out
+# Writing with ET means building the whole tree first (root, SubElement, SubElement...) and THEN tree.write()
+# A million claims = a million Element objects sitting in memory before the first byte hits the disk
+#
+# XMLWriter writes tags as we go instead: start("people"), element("person", ...), end("people")
+# Memory is one buffer, no matter how many records
+# It uses the same rules ElementTree does (same escaping, same "<tag />" for empty elements, same XML declaration rule)
+# so for the same content the file comes out byte for byte identical to tree.write()
+
+import os
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+def escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def escape_attrib(value):
+    return (escape_text(value).replace('"', "&quot;")
+            .replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#09;"))
+
+
+class XMLWriter:
+    def __init__(self, path, encoding="us-ascii", xml_declaration=None, short_empty_elements=True, buffer_parts=10_000):
+        self.path = path
+        self.encoding = encoding
+        self.xml_declaration = xml_declaration
+        self.short_empty_elements = short_empty_elements
+        self.buffer_parts = buffer_parts
+        self.parts = []
+        self.open_tags = []
+        self.start_pending = False      # Last thing written was "<tag attrs" with no ">" yet, might still become " />"
+
+    def __enter__(self):
+        # errors="xmlcharrefreplace" is what ET does too: "é" in an us-ascii file becomes "&#233;"
+        self.f = open(self.path, "w", encoding=self.encoding, errors="xmlcharrefreplace")
+        if self.xml_declaration or (self.xml_declaration is None and self.encoding.lower() not in ("utf-8", "us-ascii")):
+            self.write(f"<?xml version='1.0' encoding='{self.encoding}'?>\n")
+        return self
+
+    def write(self, part):
+        self.parts.append(part)
+        if len(self.parts) >= self.buffer_parts:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.parts))
+        self.parts = []
+
+    def close_start(self):
+        if self.start_pending:
+            self.write(">")
+            self.start_pending = False
+
+    def start(self, tag, attrib=None, **extra):
+        self.close_start()
+        attrib = {**(attrib or {}), **extra}
+        self.write("<" + tag + "".join(f' {key}="{escape_attrib(str(value))}"' for key, value in attrib.items()))
+        self.open_tags.append(tag)
+        self.start_pending = True
+
+    def text(self, text):
+        if text:
+            self.close_start()
+            self.write(escape_text(text))
+
+    def end(self):
+        tag = self.open_tags.pop()
+        if self.start_pending and self.short_empty_elements:
+            self.write(" />")
+            self.start_pending = False
+        else:
+            self.close_start()
+            self.write(f"</{tag}>")
+
+    def element(self, tag, text=None, attrib=None, **extra):
+        # A whole leaf element in one go: <tag attrs>text</tag>
+        self.start(tag, attrib, **extra)
+        self.text(text)
+        self.end()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            while self.open_tags:
+                self.end()
+        self.flush()
+        self.f.close()
+
+
+with XMLWriter("people_stream.xml") as xml:
+    xml.start("people")
+    xml.element("person", name="Alice")
+    xml.element("person", name="Bob")
+    xml.end()
+
+root = ET.Element("people")
+ET.SubElement(root, "person", name="Alice")
+ET.SubElement(root, "person", name="Bob")
+ET.ElementTree(root).write("people.xml")
+
+with open("people_stream.xml", "rb") as a, open("people.xml", "rb") as b:
+    print(a.read() == b.read())
+
+# Prints
+# True
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 300k people with a few children each
+    def build_people(count):
+        for i in range(count):
+            yield i, {"id": str(i), "name": f"Person {i} & family"}, "02-14-1990", f'{i} "Main" Street'
+
+    def with_elementtree(path, count):
+        root = ET.Element("people")
+        for i, attrib, dob, address in build_people(count):
+            person = ET.SubElement(root, "person", attrib)
+            ET.SubElement(person, "dob").text = dob
+            ET.SubElement(person, "address").text = address
+            ET.SubElement(person, "claim", code=f"A{i % 50}")
+        ET.ElementTree(root).write(path)
+
+    def with_xmlwriter(path, count):
+        with XMLWriter(path) as xml:
+            xml.start("people")
+            for i, attrib, dob, address in build_people(count):
+                xml.start("person", attrib)
+                xml.element("dob", dob)
+                xml.element("address", address)
+                xml.element("claim", code=f"A{i % 50}")
+                xml.end()
+            xml.end()
+
+    for label, func, path in [("ElementTree", with_elementtree, bench_path("claims_et.xml")), ("XMLWriter", with_xmlwriter, bench_path("claims_stream.xml"))]:
+        start = time.perf_counter()
+        func(path, 300_000)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        func(path, 300_000)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<14}{300_000 / elapsed:>10,.0f} records/s   peak {peak / 1e6:7.1f} MB   {os.path.getsize(path):,} bytes")
+
+    with open(bench_path("claims_et.xml"), "rb") as a, open(bench_path("claims_stream.xml"), "rb") as b:
+        print("identical:", a.read() == b.read())
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    ElementTree       63,802 records/s   peak   311.6 MB   42,506,687 bytes
+    XMLWriter         75,632 records/s   peak     0.7 MB   42,506,687 bytes
+    identical: True
+    """
+    # Same 42MB file either way. ET held all 1.2M Elements (311MB) until write(), the writer never holds more than its buffer
+
+# Great for outbound claim batches, big exports to vendors, anything that needs to WRITE a huge XML file
+
 # Binary Files
 # Reading/Writing raw bytes
 # Useful for dealing with images, network packets, binary logs, embedded / low level formats
@@ -273,6 +1033,270 @@ with open("data.bin", "rb") as f:
 print(databinary)
 
 
+# Binary Files, fixed size records
+# Device/telemetry logs are usually the same record over and over, ex. every 20 bytes:
+#   8 byte timestamp | 8 byte float reading | 2 byte sensor id | 2 byte flags
+# struct describes that layout the way a C struct would:  "<QdHH"   (< = little endian, no padding between fields)
+#
+# f.read() on a 5GB log = 5GB of bytes object before we can look at record #1
+# mmap (memory map) asks the OS to make the FILE look like memory instead. Nothing gets read up front,
+# the OS pages in just the parts we touch. Record #3,000,000 is at byte 3,000,000 * 20, jump straight there
+# memoryview slices of the map are zero copy, they point INTO the mapped file instead of copying bytes out
+#
+# column() pulls one field out of every record into an array, without a Python loop per record:
+#   memoryview[offset::record_size] = every record_size-th byte, starting at offset (a strided copy in C)
+#   Do that once per byte of the field, interleave them, and the result is exactly the bytes of an array
+
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+import tracemalloc
+from array import array
+
+# struct code -> array typecode with the same size. Picked by size because array's 'l' is 8 bytes on Linux
+# but struct's standard '<l' is always 4
+_SIGNED = {1: "b", 2: "h", 4: "i", 8: "q"}
+_ARRAY_CODES = {code: _SIGNED[struct.calcsize("<" + code)] for code in "bhilq"}
+_ARRAY_CODES.update({code: _SIGNED[struct.calcsize("<" + code)].upper() for code in "BHILQ"})
+_ARRAY_CODES.update({"?": "B", "f": "f", "d": "d"})
+# No array typecode for these: "c" / "s" / "p" come back as bytes (like struct gives them), "e" (half float) as floats
+_BYTES_CODES = "csp"
+_FIELD = re.compile(r"(\d*)([xcbB?hHiIlLqQefdsp])")
+
+
+def parse_fields(fmt):
+    # "<QdHH" -> [("Q", 0, 8), ("d", 8, 8), ("H", 16, 2), ("H", 18, 2)]   (code, offset, size)
+    # "10s" / "10p" is ONE 10 byte field, "3H" is three H fields, "x" is a pad byte (no field)
+    if fmt[:1] not in "<>!=":
+        raise ValueError("Use an explicit byte order (<, >, ! or =) so there's no hidden padding between fields")
+    fields = []
+    offset = 0
+    for count, code in _FIELD.findall(fmt[1:]):
+        count = int(count or 1)
+        size = struct.calcsize(fmt[0] + code)
+        if code in "sp":
+            fields.append((code, offset, count))
+            offset += count
+        elif code == "x":
+            offset += count
+        else:
+            for _ in range(count):
+                fields.append((code, offset, size))
+                offset += size
+    if offset != struct.calcsize(fmt):
+        # Something in fmt we don't know, and every offset after it would be wrong
+        raise ValueError(f"Can't work out the field offsets of {fmt!r}")
+    return fields
+
+
+class RecordFile:
+    def __init__(self, path, fmt, names=None):
+        self.path = path
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.fields = parse_fields(fmt)
+        self.names = {name: i for i, name in enumerate(names or ())}
+        self.little = fmt[0] == "<" or (fmt[0] == "=" and sys.byteorder == "little")
+        self.f = open(path, "rb")
+        self.map = None
+        self.refresh()
+
+    def refresh(self):
+        # Map the file again, call this after a writer appended more records
+        if self.map is not None:
+            self.release()
+        length = os.fstat(self.f.fileno()).st_size
+        length -= length % self.size            # Ignore a half written record at the end
+        self.count = length // self.size
+        # mmap can't map an empty file, so an empty log gets an empty map
+        self.map = mmap.mmap(self.f.fileno(), length, access=mmap.ACCESS_READ) if length else mmap.mmap(-1, 1)
+        self.view = memoryview(self.map)[:length]
+
+    def __len__(self):
+        return self.count
+
+    def index(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("record index out of range")
+        return i
+
+    def __getitem__(self, i):
+        # One record as a tuple, O(1): unpack straight out of the map at i * size
+        return self.struct.unpack_from(self.view, self.index(i) * self.size)
+
+    def raw(self, i):
+        # The record's bytes as a zero copy memoryview
+        start = self.index(i) * self.size
+        return self.view[start:start + self.size]
+
+    def records(self, start=0, stop=None):
+        stop = self.count if stop is None else min(stop, self.count)
+        return self.struct.iter_unpack(self.view[start * self.size:stop * self.size])
+
+    def column(self, field, start=0, stop=None):
+        # One field from every record -> array (or a list of bytes for "c", "s" and "p" fields)
+        code, offset, width = self.fields[self.names.get(field, field)]
+        stop = self.count if stop is None else min(stop, self.count)
+        rows = self.view[start * self.size:stop * self.size]
+        if code in _BYTES_CODES:
+            if code == "p":     # Pascal string: first byte is the length
+                return [bytes(rows[i + offset + 1:i + offset + 1 + min(rows[i + offset], width - 1)])
+                        for i in range(0, len(rows), self.size)]
+            return [bytes(rows[i + offset:i + offset + width]) for i in range(0, len(rows), self.size)]
+        if code == "e":
+            # array has no half float type, so pull the 2 byte values out and widen them to "f"
+            half = b"".join(rows[i + offset:i + offset + width] for i in range(0, len(rows), self.size))
+            return array("f", (value for (value,) in struct.iter_unpack("<e" if self.little else ">e", half)))
+        values = array(_ARRAY_CODES[code], [0]) * (stop - start)
+        values_bytes = memoryview(values).cast("B")         # Write straight into the array's own memory
+        for byte in range(width):
+            values_bytes[byte::width] = rows[offset + byte::self.size]
+        values_bytes.release()
+        if self.little != (sys.byteorder == "little"):
+            values.byteswap()
+        return values
+
+    def release(self):
+        # raw() views and records() iterators handed out earlier point INTO the map, and mmap refuses to close
+        # under them (BufferError). Then we just let go of it, they keep the old map alive and it closes
+        # itself when the last of them is gone. Everything they show stays valid until then
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+        self.map = self.view = None
+
+    def close(self):
+        if self.map is not None:
+            self.release()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordWriter:
+    def __init__(self, path, fmt, buffer_records=65_536):
+        self.path = path
+        self.struct = struct.Struct(fmt)
+        self.buffer = bytearray(self.struct.size * buffer_records)
+        self.buffer_records = buffer_records
+        self.pending = 0
+
+    def __enter__(self):
+        self.f = open(self.path, "ab")
+        return self
+
+    def append(self, *values):
+        # pack_into writes straight into the buffer, no temporary bytes object per record
+        self.struct.pack_into(self.buffer, self.pending * self.struct.size, *values)
+        self.pending += 1
+        if self.pending == self.buffer_records:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(*row)
+
+    def flush(self):
+        self.f.write(memoryview(self.buffer)[:self.pending * self.struct.size])
+        self.f.flush()
+        self.pending = 0
+
+    def __exit__(self, *exc):
+        self.flush()
+        self.f.close()
+
+
+READING = "<QdHH"       # timestamp, value, sensor id, flags
+
+if os.path.exists("readings.bin"):
+    os.remove("readings.bin")
+with RecordWriter("readings.bin", READING) as writer:
+    writer.append(1700000000, 98.6, 7, 0)
+    writer.append(1700000060, 99.1, 7, 1)
+    writer.append(1700000120, 97.9, 3, 0)
+
+with RecordFile("readings.bin", READING, names=("time", "value", "sensor", "flags")) as readings:
+    print(len(readings), readings[1], readings[-1])
+    print(bytes(readings.raw(0)))
+    print(readings.column("value"), readings.column("sensor"))
+    first = readings.raw(0)
+    with RecordWriter("readings.bin", READING) as writer:
+        writer.append(1700000180, 98.2, 3, 0)
+    readings.refresh()                  # Fine with first still pointing into the old map
+    print(len(readings), readings[-1], first.hex()[:16])
+
+# Prints
+"""
+3 (1700000060, 99.1, 7, 1) (1700000120, 97.9, 3, 0)
+b'\x00\xf1Se\x00\x00\x00\x00fffff\xa6X@\x07\x00\x00\x00'
+array('d', [98.6, 99.1, 97.9]) array('H', [7, 7, 3])
+4 (1700000180, 98.2, 3, 0) 00f1536500000000
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 5M readings (100MB). Read everything then slice vs. the mapped RecordFile
+    COUNT = 5_000_000
+    if os.path.exists(bench_path("readings_big.bin")):
+        os.remove(bench_path("readings_big.bin"))
+    with RecordWriter(bench_path("readings_big.bin"), READING) as writer:
+        for i in range(COUNT):
+            writer.append(1700000000 + i, (i % 1000) / 10, i % 64, i % 2)
+
+    def read_everything_average():
+        with open(bench_path("readings_big.bin"), "rb") as f:
+            data = f.read()
+        return sum(value for _, value, _, _ in struct.iter_unpack(READING, data)) / COUNT
+
+    def record_file_average():
+        with RecordFile(bench_path("readings_big.bin"), READING) as readings:
+            return sum(readings.column(1)) / len(readings)
+
+    def read_everything_lookups():
+        with open(bench_path("readings_big.bin"), "rb") as f:
+            data = f.read()
+        size = struct.calcsize(READING)
+        return [struct.unpack_from(READING, data, (i * 7919 % COUNT) * size) for i in range(100_000)]
+
+    def record_file_lookups():
+        with RecordFile(bench_path("readings_big.bin"), READING) as readings:
+            return [readings[i * 7919 % COUNT] for i in range(100_000)]
+
+    for label, func in [("average, read everything", read_everything_average), ("average, RecordFile.column", record_file_average),
+                        ("100k lookups, read everything", read_everything_lookups), ("100k lookups, RecordFile", record_file_lookups)]:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<32}{elapsed * 1000:>8.0f} ms   peak {peak / 1e6:7.1f} MB")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    average, read everything             830 ms   peak   100.0 MB
+    average, RecordFile.column           488 ms   peak    45.0 MB
+    100k lookups, read everything        176 ms   peak   113.5 MB
+    100k lookups, RecordFile              87 ms   peak    13.5 MB
+    """
+    # Read everything always costs the whole file (100MB here, 5GB for a 5GB log) before the first answer
+    # column()'s 45MB is the result itself, 5M floats at 8 bytes each. The lookups only cost the 100k tuples they return
+    # tracemalloc only counts Python's memory. The mapped file shows up as OS page cache, which the OS can drop any time
+
+# Great for telemetry, device logs, sensor data, market ticks, anything written as the same C struct over and over
+
 # Pickles (Python's built in object serializer)
 # Use with caution, only unpickle trusted data
 """
@@ -285,11 +1309,248 @@ obj = {"a":1, "b":[1, 2, 3]}
 with open("state.pkl", "wb") as f:
     pickle.dump(obj, f)
 
-# Read
-with open("state.pkl") as f:
+# Read, "rb" too. Pickles are bytes, text mode would try to decode them as UTF-8 and fail
+with open("state.pkl", "rb") as f:
     objread = pickle.load(f)
 """
 
+# Pickles, checkpointing big state
+# pickle.dump(state, f) on every save re-pickles EVERYTHING, even if only one small counter changed,
+# and it copies every big bytes buffer into the pickle stream on the way out (and again on the way in)
+#
+# CheckpointStore fixes both:
+#   1) One file per top level key. Setting store["key"] = value marks it changed, and checkpoint() only writes changed keys
+#      (changed a list IN PLACE? call store.touch("key"), the store can't see inside the list)
+#   2) Pickle protocol 5 "out-of-band" buffers: with a buffer_callback, buffers that ASK for it (anything wrapped in
+#      pickle.PickleBuffer(x), numpy arrays do it themselves) are NOT copied into the pickle stream. We get handed
+#      the raw buffer and write it straight to the file. A plain bytes/bytearray is still copied into the stream,
+#      wrap it in PickleBuffer to get it out-of-band
+#      On load the file is memory mapped and each buffer is a slice of the map: a PickleBuffer comes back as a
+#      read only PickleBuffer INTO the file, zero copy, nothing read up front. bytes(x) / x.raw() to get at it,
+#      and it can go straight back into the store (a memoryview couldn't, memoryviews can't be pickled)
+#   3) Crash safe: everything is written to a temp file, fsync'd, then os.replace()'d into place. os.replace is atomic,
+#      so the manifest (key -> file) is always the complete old one or the complete new one, never half of each
+#
+# Same warning as plain pickle: only load checkpoints you wrote yourself
+
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import time
+
+_MAGIC = b"CKP5"
+_HEADER = struct.Struct("<4sQI")        # magic, pickle length, number of out-of-band buffers
+_ALIGN = 64                             # Start every buffer on a 64 byte boundary, friendlier for whoever reads it
+
+
+def fsync_dir(path):
+    # A rename isn't durable until the directory itself is fsync'd (POSIX). Windows doesn't need/allow this
+    if os.name == "posix":
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def atomic_write(path, parts):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for part in parts:
+            f.write(part)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, "manifest.pkl")
+        self.manifest = {}          # key -> file name
+        self.generation = 0
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "rb") as f:
+                self.generation, self.manifest = pickle.load(f)
+        self.values = {}            # Keys loaded or set so far, the rest stay on disk until asked for
+        self.dirty = set()
+        self.maps = {}              # file name -> its mmap, open while buffers loaded from it might still be around
+        self.clean()
+
+    def clean(self):
+        # Leftovers from a crash (.tmp files, data files the manifest never got to point at) are safe to delete
+        keep = set(self.manifest.values()) | {"manifest.pkl"}
+        for name in os.listdir(self.directory):
+            if name not in keep and (name.endswith(".ckpt") or name.endswith(".tmp")):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass        # Windows won't delete a file something still has mapped, next clean() gets it
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        self.dirty.add(key)
+
+    def __getitem__(self, key):
+        if key not in self.values:
+            if key not in self.manifest:
+                raise KeyError(key)
+            self.values[key] = self.load(self.manifest[key])
+        return self.values[key]
+
+    def __delitem__(self, key):
+        self.values.pop(key, None)
+        self.manifest.pop(key, None)
+        self.dirty.add(key)
+
+    def __contains__(self, key):
+        return key in self.values or key in self.manifest
+
+    def keys(self):
+        return set(self.manifest) | set(self.values)
+
+    def touch(self, key):
+        self.dirty.add(key)
+
+    def load(self, name):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        magic, pickle_length, count = _HEADER.unpack_from(view)
+        if magic != _MAGIC:
+            raise ValueError(f"{name} is not a checkpoint file")
+        lengths = struct.unpack_from(f"<{count}Q", view, _HEADER.size)
+        position = _HEADER.size + 8 * count
+        data = view[position:position + pickle_length]
+        position += pickle_length
+        buffers = []
+        for length in lengths:
+            position += -position % _ALIGN
+            buffers.append(pickle.PickleBuffer(view[position:position + length]))
+            position += length
+        self.maps[name] = mapped
+        return pickle.loads(data, buffers=buffers)
+
+    def write(self, key, value):
+        buffers = []
+        data = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        raws = [buffer.raw() for buffer in buffers]
+        parts = [_HEADER.pack(_MAGIC, len(data), len(raws)), struct.pack(f"<{len(raws)}Q", *(raw.nbytes for raw in raws)), data]
+        position = sum(map(len, parts))
+        for raw in raws:
+            parts.append(bytes(-position % _ALIGN))
+            parts.append(raw)
+            position += len(parts[-2]) + raw.nbytes
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+        name = f"{digest}.{self.generation}.ckpt"
+        atomic_write(os.path.join(self.directory, name), parts)
+        return name
+
+    def checkpoint(self):
+        # Returns the keys that were written
+        if not self.dirty:
+            return []
+        self.generation += 1
+        written = sorted((key for key in self.dirty if key in self.values), key=repr)
+        for key in written:
+            self.manifest[key] = self.write(key, self.values[key])
+        # The commit point. Before this line a crash leaves the old manifest pointing at the old, untouched files
+        atomic_write(self.manifest_path, [pickle.dumps((self.generation, self.manifest), protocol=5)])
+        fsync_dir(self.directory)
+        self.dirty.clear()
+        self.release_maps()
+        self.clean()            # The files the old manifest pointed at aren't needed anymore
+        return written
+
+    def release_maps(self):
+        # Close the maps of files the manifest doesn't point at anymore. If something still holds a buffer
+        # from one, close() raises BufferError: then just let go of it, it closes itself when the last one is gone
+        live = set(self.manifest.values())
+        for name in [name for name in self.maps if name not in live]:
+            try:
+                self.maps.pop(name).close()
+            except BufferError:
+                pass
+
+
+store = CheckpointStore("pipeline_state")
+store["progress"] = {"last_id": 1200, "errors": 3}
+store["seen"] = ["claim-1", "claim-2"]
+store["blob"] = pickle.PickleBuffer(bytearray(b"raw payload bytes"))
+print(store.checkpoint())
+
+store["progress"] = {"last_id": 1300, "errors": 3}
+print(store.checkpoint())               # Only progress gets rewritten
+
+restored = CheckpointStore("pipeline_state")
+print(restored["progress"], restored["seen"], bytes(restored["blob"]), type(restored["blob"]).__name__)
+restored.touch("blob")                  # A loaded buffer can go straight back into the store
+print(restored.checkpoint(), bytes(CheckpointStore("pipeline_state")["blob"]))
+
+# Prints
+"""
+['blob', 'progress', 'seen']
+['progress']
+{'last_id': 1300, 'errors': 3} ['claim-1', 'claim-2'] b'raw payload bytes' PickleBuffer
+['blob'] b'raw payload bytes'
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: ~330MB of state. 100 x 3MB image buffers, 1M log lines, and a small progress dict that changes every save
+    # Plain pickle.dump of the whole thing vs. the store, where only "progress" changed since the last checkpoint
+    state = {
+        "images": [pickle.PickleBuffer(bytearray(os.urandom(1024)) * 3072) for _ in range(100)],
+        "log": [f"2024-01-01 12:00:{i % 60:02} processed claim {i}" for i in range(1_000_000)],
+        "progress": {"last_id": 0},
+    }
+
+    start = time.perf_counter()
+    with open(bench_path("state_full.pkl"), "wb") as f:
+        pickle.dump({**state, "images": [bytearray(image) for image in state["images"]]}, f, protocol=5)
+        f.flush()
+        os.fsync(f.fileno())
+    print(f"pickle.dump everything         {time.perf_counter() - start:6.2f}s")
+
+    start = time.perf_counter()
+    with open(bench_path("state_full.pkl"), "rb") as f:
+        loaded = pickle.load(f)
+    print(f"pickle.load everything         {time.perf_counter() - start:6.2f}s")
+    del loaded
+
+    store = CheckpointStore(bench_path("pipeline_bench"))
+    for key, value in state.items():
+        store[key] = value
+    start = time.perf_counter()
+    store.checkpoint()
+    print(f"first checkpoint (all keys)    {time.perf_counter() - start:6.2f}s")
+
+    store["progress"] = {"last_id": 5000}
+    start = time.perf_counter()
+    written = store.checkpoint()
+    print(f"next checkpoint {written}  {time.perf_counter() - start:6.3f}s")
+
+    start = time.perf_counter()
+    reopened = CheckpointStore(bench_path("pipeline_bench"))
+    images = reopened["images"]
+    progress = reopened["progress"]
+    print(f"open + load images/progress    {time.perf_counter() - start:6.3f}s   ({len(images)} images as {type(images[0]).__name__}s)")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    pickle.dump everything           0.94s
+    pickle.load everything           0.41s
+    first checkpoint (all keys)      0.67s
+    next checkpoint ['progress']   0.001s
+    open + load images/progress     0.000s   (100 images as PickleBuffers)
+    """
+    # Every save after the first costs what CHANGED, not what exists. ~1ms vs ~1s, and it'd be the same 1ms at 3GB
+    # Loading is lazy and the images are mapped, not read. The OS pulls in the pages of an image when we actually touch it
+
+# Great for long running pipelines, scrapers, ETL jobs, anything that has to pick up where it left off after a crash
+
 # YAML
 # Used for configs, DevOps, Docker, cloud
 # Commenting most of this out, needs a module installed by pip
@@ -334,6 +1595,1298 @@ print(rows)
 conn.close()
 
 
+# SQLite, pooled
+# connect -> execute -> commit -> close, over and over, is fine for a script. For a service doing it thousands of
+# times a second, most of the time goes to the "connect" part:
+#   opening the file, reading the schema, setting up the page cache (which starts out EMPTY every time)
+#   compiling the SQL text into a prepared statement (SQLite's bytecode) every single query
+#
+# ConnectionPool keeps a few connections open and hands them out:
+#   with pool.connection() as conn: ...      checkout, and it goes back in the pool on the way out
+#   Idle connections are kept LIFO, so the next checkout gets the one that was used last (warmest page cache)
+#   The same thread asking again while it already holds one (nested calls) gets the SAME connection back
+#   cached_statements = sqlite3's own prepared statement cache, per connection. Same SQL text -> no recompile
+#   Pragmas are set once per connection, not per query:
+#       journal_mode=WAL     readers don't block the writer and the writer doesn't block readers
+#       synchronous=NORMAL   with WAL this is still safe from corruption, just skips an fsync per commit
+#       cache_size=-65536    negative = KB, so 64MB of page cache per connection (default is ~2MB)
+#       mmap_size            read the file through memory mapping instead of read() calls
+#       busy_timeout         wait for a lock instead of failing instantly with "database is locked"
+
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -65536,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.opened = 0
+        self.reused = 0         # Checkouts that got an already open connection
+        self.waits = 0          # Checkouts that had to wait because every connection was busy
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def __repr__(self):
+        reuse = self.reused / self.checkouts if self.checkouts else 0
+        return (f"PoolStats(checkouts={self.checkouts}, opened={self.opened}, reuse={reuse:.1%}, waits={self.waits}, "
+                f"wait_seconds={self.wait_seconds:.3f}, max_wait_ms={self.max_wait_seconds * 1000:.1f})")
+
+
+class ConnectionPool:
+    def __init__(self, path, size=8, timeout=10.0, pragmas=None, cached_statements=256):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.local = threading.local()      # What THIS thread currently has checked out
+        self.all = []
+        self.stats = PoolStats()
+
+    def open(self):
+        # check_same_thread=False: a connection may be used by a different thread next time. That's safe because
+        # the pool only ever lets one thread hold it at a time
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def acquire(self):
+        with self.lock:
+            self.stats.checkouts += 1
+            try:
+                conn = self.idle.get_nowait()
+                self.stats.reused += 1
+                return conn
+            except queue.Empty:
+                if len(self.all) < self.size:
+                    self.stats.opened += 1
+                    conn = self.open()
+                    self.all.append(conn)
+                    return conn
+        # Pool is full and every connection is busy, wait for one to come back
+        start = time.perf_counter()
+        try:
+            conn = self.idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free connection to {self.path} after {self.timeout}s") from None
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.stats.reused += 1
+            self.stats.waits += 1
+            self.stats.wait_seconds += waited
+            self.stats.max_wait_seconds = max(self.stats.max_wait_seconds, waited)
+        return conn
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()     # Someone forgot to commit, don't hand a half done transaction to the next caller
+        self.idle.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        held = getattr(self.local, "conn", None)
+        if held is not None:
+            yield held          # Nested checkout in the same thread, reuse what we're already holding
+            return
+        conn = self.local.conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            self.release(conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Commit if the block finishes, roll back if it raises
+        with self.connection() as conn:
+            with conn:
+                yield conn
+
+    def execute(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            for conn in self.all:
+                conn.close()
+            self.all.clear()
+            self.idle = queue.LifoQueue()
+
+
+pool = ConnectionPool("people.db", size=4)
+
+with pool.transaction() as conn:
+    conn.execute("CREATE TABLE IF NOT EXISTS users (name TEXT, age INTEGER)")
+    conn.execute("INSERT INTO users VALUES (?, ?)", ("Bob", 81))
+
+print(pool.execute("SELECT * FROM users WHERE name = ?", ("Bob",))[:1])
+print(pool.execute("PRAGMA journal_mode"))
+print(pool.stats)
+pool.close()
+
+# Prints
+"""
+[('Bob', 81)]
+[('wal',)]
+PoolStats(checkouts=3, opened=1, reuse=66.7%, waits=0, wait_seconds=0.000, max_wait_ms=0.0)
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 20k primary key lookups on a 100k row table, connect-per-query vs. the pool
+    # Then 8 threads sharing a pool of 4, to see what waiting for a connection costs
+    with contextlib.closing(sqlite3.connect(bench_path("pool_bench.db"))) as conn:
+        conn.execute("DROP TABLE IF EXISTS patients")
+        conn.execute("CREATE TABLE patients (id INTEGER PRIMARY KEY, name TEXT, age INTEGER)")
+        conn.executemany("INSERT INTO patients VALUES (?, ?, ?)", ((i, f"Person {i}", i % 100) for i in range(100_000)))
+        conn.commit()
+
+    LOOKUPS = 20_000
+
+    def connect_per_query():
+        for i in range(LOOKUPS):
+            conn = sqlite3.connect(bench_path("pool_bench.db"))
+            conn.execute("SELECT name, age FROM patients WHERE id = ?", (i * 7 % 100_000,)).fetchone()
+            conn.close()
+
+    bench_pool = ConnectionPool(bench_path("pool_bench.db"), size=4)
+
+    def pooled():
+        for i in range(LOOKUPS):
+            with bench_pool.connection() as conn:
+                conn.execute("SELECT name, age FROM patients WHERE id = ?", (i * 7 % 100_000,)).fetchone()
+
+    def pooled_threads(threads=8):
+        def work(offset):
+            for i in range(offset, LOOKUPS, threads):
+                with bench_pool.connection() as conn:
+                    conn.execute("SELECT name, age FROM patients WHERE id = ?", (i * 7 % 100_000,)).fetchone()
+        workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    for label, func in [("connect per query", connect_per_query), ("pool", pooled), ("pool, 8 threads", pooled_threads)]:
+        start = time.perf_counter()
+        func()
+        print(f"{label:<20}{LOOKUPS / (time.perf_counter() - start):>10,.0f} queries/s")
+    print(bench_pool.stats)
+    bench_pool.close()
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    connect per query       10,129 queries/s
+    pool                    76,604 queries/s
+    pool, 8 threads         77,793 queries/s
+    PoolStats(checkouts=40000, opened=4, reuse=100.0%, waits=4, wait_seconds=0.378, max_wait_ms=154.7)
+    """
+    # ~7.5x, and that's with the database already in the OS file cache. The query itself is microseconds,
+    # the connect/close around it was most of the cost
+    # Threads don't add speed here (1 core, and the GIL), but 8 threads sharing 4 connections barely ever had to wait
+
+# Great for web backends, API services, job workers, anything that talks to the same SQLite file over and over
+
+# SQLite, streaming reads
+# cursor.fetchall() builds ONE list holding EVERY row as a tuple. Fine for the users table above,
+# a multi GB memory spike for a table with tens of millions of rows
+#
+# Two ways to read a huge table in constant memory:
+#   iter_query()   -> one query, pull rows out of the cursor fetchmany(batch_size) at a time
+#                     The cursor only holds its current position, SQLite produces rows as we ask for them
+#   keyset_pages() -> many small queries, each picking up after the last key we saw:
+#                         SELECT ... WHERE id > :last_id ORDER BY id LIMIT 10000
+#                     Each page is its own short query, so no read transaction stays open for the whole export,
+#                     and if the export dies at page 900 it can resume from the last id instead of starting over
+#                     (OFFSET looks similar, but OFFSET 9,000,000 makes SQLite walk past 9 million rows to get there)
+#
+# Row factories: plain tuples are the smallest and fastest. If you want row.name instead of row[0]:
+#   namedtuple_rows -> a namedtuple class built from the column names (still a tuple underneath)
+#   slots_rows      -> a small class with __slots__, no per row __dict__, attributes can be changed
+
+import sqlite3
+import time
+import tracemalloc
+from collections import namedtuple
+from functools import lru_cache
+
+@lru_cache(maxsize=256)
+def namedtuple_rows(columns):
+    # Built once per distinct set of columns, not once per query
+    return namedtuple("Row", columns)._make
+
+@lru_cache(maxsize=256)
+def slots_rows(columns):
+    def __init__(self, values):
+        for name, value in zip(columns, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "Record(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in columns) + ")"
+
+    return type("Record", (), {"__slots__": columns, "__init__": __init__, "__repr__": __repr__})
+
+
+def iter_query(conn, sql, params=(), batch_size=1000, row_factory=None, batches=False):
+    # batches=True yields lists of up to batch_size rows (handy for executemany / writer.writerows)
+    # batches=False yields one row at a time
+    cursor = conn.execute(sql, params)
+    make = row_factory(tuple(column[0] for column in cursor.description)) if row_factory else None
+    try:
+        while rows := cursor.fetchmany(batch_size):
+            if make is not None:
+                rows = list(map(make, rows))
+            if batches:
+                yield rows
+            else:
+                yield from rows
+    finally:
+        cursor.close()      # If the caller stops early, don't leave the statement open
+
+
+def keyset_pages(conn, table, key="id", columns="*", where="", params=(), page_size=10_000, after=None, row_factory=None):
+    # table / key / columns / where are pasted into the SQL, so they must come from OUR code, never from user input
+    # key must be unique and indexed (the primary key is perfect). Yields (last_key, rows), save last_key to resume
+    sql = f"SELECT {columns}, {key} FROM {table} WHERE {key} > ?{f' AND ({where})' if where else ''} ORDER BY {key} LIMIT ?"
+    make = None
+    while True:
+        cursor = conn.execute(sql, (after if after is not None else -2 ** 63, *params, page_size))
+        if make is None and row_factory is not None:
+            make = row_factory(tuple(column[0] for column in cursor.description[:-1]))
+        page = cursor.fetchall()
+        if not page:
+            return
+        after = page[-1][-1]
+        rows = [row[:-1] for row in page]       # Drop the key we tacked on the end
+        yield after, list(map(make, rows)) if make else rows
+        if len(page) < page_size:
+            return
+
+
+conn = sqlite3.connect("people.db")
+conn.execute("CREATE TABLE IF NOT EXISTS users (name TEXT, age INTEGER)")
+
+for user in iter_query(conn, "SELECT name, age FROM users WHERE age > ?", (18,), row_factory=namedtuple_rows):
+    print(user.name, user.age)
+
+for last_rowid, page in keyset_pages(conn, "users", key="rowid", columns="name, age", page_size=1, row_factory=slots_rows):
+    print(last_rowid, page)
+conn.close()
+
+# Prints (depends what's in people.db by now)
+"""
+Alice 30
+Bob 81
+1 [Record(name='Alice', age=30)]
+2 [Record(name='Bob', age=81)]
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 1M row table, sum the ages every way
+    # A tens-of-millions row table is the same picture, fetchall's memory just keeps growing with it
+    conn = sqlite3.connect(bench_path("stream_bench.db"))
+    conn.execute("DROP TABLE IF EXISTS patients")
+    conn.execute("CREATE TABLE patients (id INTEGER PRIMARY KEY, name TEXT, dob TEXT, age INTEGER)")
+    with conn:
+        conn.executemany("INSERT INTO patients VALUES (?, ?, ?, ?)",
+                         ((i, f"Person {i}", f"{i % 12 + 1:02}-14-1990", i % 100) for i in range(1_000_000)))
+
+    def with_fetchall():
+        return sum(row[3] for row in conn.execute("SELECT * FROM patients").fetchall())
+
+    def with_iter_query():
+        return sum(row[3] for row in iter_query(conn, "SELECT * FROM patients", batch_size=5000))
+
+    def with_iter_query_namedtuple():
+        return sum(row.age for row in iter_query(conn, "SELECT * FROM patients", batch_size=5000, row_factory=namedtuple_rows))
+
+    def with_iter_query_slots():
+        return sum(row.age for row in iter_query(conn, "SELECT * FROM patients", batch_size=5000, row_factory=slots_rows))
+
+    def with_keyset_pages():
+        return sum(row[3] for _, page in keyset_pages(conn, "patients") for row in page)
+
+    for label, func in [("fetchall", with_fetchall), ("iter_query", with_iter_query), ("  + namedtuple_rows", with_iter_query_namedtuple),
+                        ("  + slots_rows", with_iter_query_slots), ("keyset_pages", with_keyset_pages)]:
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:<20}{1_000_000 / elapsed:>12,.0f} rows/s   peak {peak / 1e6:7.1f} MB")
+    conn.close()
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    fetchall                 640,050 rows/s   peak   233.2 MB
+    iter_query               823,974 rows/s   peak     2.3 MB
+      + namedtuple_rows      622,458 rows/s   peak     2.4 MB
+      + slots_rows           466,741 rows/s   peak     2.3 MB
+    keyset_pages             719,902 rows/s   peak     6.4 MB
+    """
+    # fetchall: 233MB for 1M rows, so ~2-3GB at 10M. The streaming versions stay at one batch/page
+    # and are FASTER, because they never have to grow (and later free) one giant list
+    # Row factories cost a Python call per row, use them when readable code matters more than the last bit of speed
+
+# Great for exports, nightly jobs, data migrations, anything that walks a whole table
+
+# SQLite, bulk loading a CSV
+# INSERT one row, commit, INSERT the next row, commit... Every commit waits for the disk (fsync) to confirm
+# the row is really saved, so that tops out around a few thousand rows a second however fast the CPU is
+#
+# The fast path:
+#   1) ONE transaction per million rows instead of one per row (the fsync happens once per million)
+#   2) executemany() fed straight from csv.reader. Both are C, so rows go from the file to SQLite
+#      without a Python loop in between
+#   3) Relax the safety pragmas for the load only (restored after):
+#         synchronous=OFF, journal_mode=OFF  -> no fsyncs, no rollback journal
+#         A crash halfway can leave a broken file, which is fine for a load we can just rerun from the CSV
+#         Never leave these on for normal use
+#   4) Indexes LAST. With an index in place, every insert also updates the index B-tree in random order.
+#      Building the index after sorts all the values once, which is way cheaper
+#
+# No int() calls needed: a column declared INTEGER has "integer affinity", so SQLite turns the text "30"
+# into the number 30 itself as it stores it
+
+import contextlib
+import csv
+import itertools
+import os
+import random
+import sqlite3
+import time
+
+BULK_PRAGMAS = {"synchronous": "OFF", "journal_mode": "OFF", "cache_size": -262144, "temp_store": "MEMORY"}
+
+
+class LoadStats:
+    def __init__(self):
+        self.rows = 0
+        self.load_seconds = 0.0
+        self.index_seconds = 0.0
+
+    def __repr__(self):
+        rate = self.rows / self.load_seconds if self.load_seconds else 0
+        return (f"LoadStats(rows={self.rows:,}, load_seconds={self.load_seconds:.2f}, index_seconds={self.index_seconds:.2f}, "
+                f"rows_per_sec={rate:,.0f})")
+
+
+@contextlib.contextmanager
+def relaxed_pragmas(conn, pragmas=BULK_PRAGMAS):
+    # Remember what each pragma was, set the fast values, put the old ones back at the end no matter what
+    saved = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in pragmas}
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+
+
+def quote_name(name):
+    # "First Name" / order / a header with a " in it -> one safe SQL identifier. Column names can't be ? parameters
+    return '"' + name.replace('"', '""') + '"'
+
+
+def bulk_load_csv(conn, path, table, types=None, indexes=None, transaction_rows=1_000_000):
+    # types   -> {"age": "INTEGER"}, anything not listed is TEXT
+    # indexes -> {"idx_users_name": "name"}, dropped before the load and (re)built after it
+    # types and the index columns are pasted into the SQL as is, so they come from our code, not from user input
+    # The column names come from the CSV header, so those (and the table / index names) get quoted
+    types = types or {}
+    indexes = indexes or {}
+    stats = LoadStats()
+    old_isolation = conn.isolation_level
+    conn.isolation_level = None         # We send BEGIN/COMMIT ourselves
+    try:
+        with open(path, newline="") as f, relaxed_pragmas(conn):
+            reader = csv.reader(f)
+            header = next(reader)
+            columns = ", ".join(f"{quote_name(name)} {types.get(name, 'TEXT')}" for name in header)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {quote_name(table)} ({columns})")
+            for name in indexes:
+                conn.execute(f"DROP INDEX IF EXISTS {quote_name(name)}")
+            insert = (f"INSERT INTO {quote_name(table)} ({', '.join(map(quote_name, header))}) "
+                      f"VALUES ({', '.join('?' * len(header))})")
+
+            start = time.perf_counter()
+            while True:
+                conn.execute("BEGIN")
+                try:
+                    inserted = conn.executemany(insert, itertools.islice(reader, transaction_rows)).rowcount
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                stats.rows += inserted
+                if inserted < transaction_rows:
+                    break
+            stats.load_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for name, column in indexes.items():
+                conn.execute(f"CREATE INDEX {quote_name(name)} ON {quote_name(table)} ({column})")
+            conn.execute(f"ANALYZE {quote_name(table)}")         # Fresh statistics so the query planner knows about the new indexes
+            stats.index_seconds = time.perf_counter() - start
+    finally:
+        conn.isolation_level = old_isolation
+    return stats
+
+
+# The Chapter way, one INSERT + commit per row (only 2k rows, it's slow)
+with open("people_2k.csv", "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(["name", "age"])
+    writer.writerows([f"Person {i}", i % 100] for i in range(2000))
+
+if os.path.exists("bulk.db"):
+    os.remove("bulk.db")
+conn = sqlite3.connect("bulk.db")
+conn.execute("CREATE TABLE users (name TEXT, age INTEGER)")
+start = time.perf_counter()
+with open("people_2k.csv", newline="") as f:
+    reader = csv.reader(f)
+    next(reader)
+    for name, age in reader:
+        conn.execute("INSERT INTO users VALUES (?, ?)", (name, int(age)))
+        conn.commit()
+print(f"row by row       {2000 / (time.perf_counter() - start):>12,.0f} rows/s")
+conn.close()
+
+# The fast path on the same 2k rows: one transaction, executemany, relaxed pragmas, index built after the load
+conn = sqlite3.connect("bulk.db")
+stats = bulk_load_csv(conn, "people_2k.csv", "users_bulk", types={"age": "INTEGER"}, indexes={"idx_users_bulk_age": "age"})
+print(f"bulk_load_csv    {stats.rows / stats.load_seconds:>12,.0f} rows/s")
+print(stats.rows, conn.execute("SELECT COUNT(*), typeof(age) FROM users_bulk WHERE age = 42").fetchone())
+conn.close()
+
+# Prints (numbers from my machine, yours will differ)
+"""
+row by row              2,273 rows/s
+bulk_load_csv         411,549 rows/s
+2000 (20, 'integer')
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 10M rows (~300MB of CSV), name/dob/address/age like people.csv
+    with open(bench_path("people_10m.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "dob", "address", "age"])
+        names = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank"]
+        streets = ["Main Street", "Side Road", "Oak Avenue", "Elm Court"]
+        for _ in range(10_000):
+            writer.writerows([random.choice(names), f"{random.randint(1, 12):02}-{random.randint(1, 28):02}-{random.randint(1930, 2020)}",
+                              f"{random.randint(1, 999)} {random.choice(streets)}", random.randint(0, 100)] for _ in range(1000))
+
+    conn = sqlite3.connect(bench_path("bulk.db"))
+    stats = bulk_load_csv(conn, bench_path("people_10m.csv"), "users", types={"age": "INTEGER"}, indexes={"idx_users_name": "name", "idx_users_age": "age"})
+    print(stats)
+    print(conn.execute("SELECT COUNT(*), SUM(age), typeof(age) FROM users").fetchone())
+    print(conn.execute("PRAGMA synchronous").fetchone(), conn.execute("PRAGMA journal_mode").fetchone())
+    conn.close()
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    row by row              2,383 rows/s
+    LoadStats(rows=10,000,000, load_seconds=23.57, index_seconds=31.63, rows_per_sec=424,204)
+    (10000000, 499985285, 'integer')
+    (2,) ('delete',)
+    """
+    # ~180x faster than row by row, and the ages really did end up as integers. The pragmas went back to normal after
+    # The load alone is well under a minute, but load + the two indexes came to 55s, so "10M rows well under a minute"
+    # is NOT met end to end on this box (1 slow core). The index build is the bigger half now, skip indexes the job
+    # doesn't query on. About half the load time is csv.reader itself: parse on every core (see above) and feed
+    # the rows to this same executemany. SQLite only has one writer, so the inserts themselves stay on one thread
+
+# Great for loading nightly extracts, vendor files, seeding test databases
+
+# SQLite, one writer for many threads
+# SQLite lets any number of connections READ at once, but only ONE can write at a time. 8 worker threads each doing
+# execute + commit per row means 8 threads queueing up for the same lock, every commit paying for its own fsync,
+# and whoever waits longer than the timeout gets "sqlite3.OperationalError: database is locked"
+#
+# Write-behind: the workers don't write at all. They drop the write on a queue and go back to work.
+# ONE writer thread owns the only writing connection and drains the queue in batches:
+#   BEGIN, up to flush_size writes, COMMIT     (or whatever arrived within flush_interval seconds)
+# No lock fights (there's only one writer) and one fsync per batch instead of per row
+#
+# submit() returns a Future. future.result() waits until the COMMIT that included our write is done,
+# so a caller that has to know the row is saved (durability ack) can wait, and everyone else just doesn't
+# close() (or leaving the with block) writes out whatever is still queued before returning
+
+import concurrent.futures
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+_FLUSH = object()
+_STOP = object()
+
+
+def fail(future, error):
+    try:
+        future.set_exception(error)
+    except concurrent.futures.InvalidStateError:
+        pass        # Already answered
+
+
+class WriteBehindStats:
+    def __init__(self):
+        self.writes = 0
+        self.failed = 0
+        self.batches = 0
+        self.commit_seconds = 0.0
+
+    def __repr__(self):
+        average = self.writes / self.batches if self.batches else 0
+        return (f"WriteBehindStats(writes={self.writes}, failed={self.failed}, batches={self.batches}, "
+                f"avg_batch={average:.0f}, commit_seconds={self.commit_seconds:.2f})")
+
+
+class WriteBehind:
+    def __init__(self, path, flush_size=1000, flush_interval=0.05, max_queue=100_000, pragmas=None):
+        # max_queue: if the writer falls that far behind, submit() blocks until it catches up (backpressure),
+        # instead of the queue eating all the memory
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        # WAL etc. from the pool section above, but synchronous=FULL no matter what: with WAL, NORMAL can lose the last
+        # commits on a power cut, and future.result() promises the write is saved. It's one fsync per BATCH anyway
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {}), "synchronous": "FULL"}
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stats = WriteBehindStats()
+        self.closed = False
+        self.error = None           # Set if the writer thread itself died, nothing would ever answer a submit() then
+        self.lock = threading.Lock()        # closed check + queue.put as one step, so nothing lands after _STOP
+        self.thread = threading.Thread(target=self.run, name="sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, sql, params=()):
+        return self.put(sql, params)
+
+    def flush(self):
+        # Commit everything submitted so far right now, and wait for it
+        return self.put(_FLUSH, None).result()
+
+    def put(self, sql, params):
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("WriteBehind is closed")
+            if self.error is not None:
+                raise RuntimeError("WriteBehind's writer thread died") from self.error
+            self.queue.put((sql, params, future))
+        if self.error is not None:
+            fail(future, self.error)        # It died while we were queueing, nobody is left to take this one
+        return future
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put((_STOP, None, None))
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def next_batch(self):
+        # Block for the first write, then keep taking more until the batch is full or flush_interval runs out
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size and batch[-1][0] is not _FLUSH and batch[-1][0] is not _STOP:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        try:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            for name, value in self.pragmas.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+            stopping = False
+            while not stopping:
+                batch = self.next_batch()
+                stopping = any(sql is _STOP for sql, _, _ in batch)
+                try:
+                    self.write_batch(conn, batch)
+                except Exception as error:
+                    # BEGIN IMMEDIATE gave up waiting for the lock, COMMIT failed, the disk is full...
+                    # Every write in this batch fails with that error, and the writer goes on to the next batch
+                    if conn.in_transaction:
+                        try:
+                            conn.execute("ROLLBACK")
+                        except sqlite3.Error:
+                            pass        # SQLite may have rolled back already, either way nothing of the batch is saved
+                    for _, _, future in batch:
+                        if future is not None and not future.done():
+                            self.stats.failed += 1
+                            fail(future, error)
+            conn.close()
+        except BaseException as error:
+            # Couldn't even open the database (or something we didn't expect): make every later submit() raise
+            self.error = error
+            raise
+        finally:
+            # Whatever is still queued will never be written, fail it instead of leaving callers waiting forever
+            error = self.error or RuntimeError("WriteBehind is closed")
+            while True:
+                try:
+                    _, _, future = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if future is not None:
+                    fail(future, error)
+
+    def write_batch(self, conn, batch):
+        done = []
+        conn.execute("BEGIN IMMEDIATE")        # Take the write lock now, not halfway through the batch
+        for sql, params, future in batch:
+            if sql is _STOP:
+                continue
+            # The caller may have cancelled the future while it sat in the queue: then don't write it at all.
+            # Otherwise it's "running" from here on and can't be cancelled, so set_result() after COMMIT can't fail
+            if not future.set_running_or_notify_cancel():
+                continue
+            if sql is _FLUSH:
+                done.append((future, None))
+                continue
+            try:
+                cursor = conn.execute(sql, params)
+                done.append((future, cursor.lastrowid))
+            except sqlite3.Error as error:
+                # Usually only this statement is undone, and the rest of the batch still commits
+                self.stats.failed += 1
+                future.set_exception(error)
+                if not conn.in_transaction:
+                    # ...but some errors (RAISE(ROLLBACK) in a trigger, disk full, I/O error) roll back the whole
+                    # transaction. Going on would run the rest in autocommit, saving writes we'd then report as failed,
+                    # so stop here: run() fails every write of the batch not answered yet, none of them is saved
+                    raise
+        start = time.perf_counter()
+        conn.execute("COMMIT")
+        self.stats.commit_seconds += time.perf_counter() - start
+        self.stats.batches += 1
+        self.stats.writes += len(done)
+        for future, result in done:
+            future.set_result(result)      # Only now, after the COMMIT, is the write really saved
+
+
+if os.path.exists("people_wb.db"):
+    os.remove("people_wb.db")
+with sqlite3.connect("people_wb.db") as conn:
+    conn.execute("CREATE TABLE users (name TEXT UNIQUE, age INTEGER)")
+conn.close()
+
+with WriteBehind("people_wb.db") as writer:
+    writer.submit("INSERT INTO users VALUES (?, ?)", ("Alice", 30))
+    saved = writer.submit("INSERT INTO users VALUES (?, ?)", ("Bob", 81))
+    duplicate = writer.submit("INSERT INTO users VALUES (?, ?)", ("Bob", 82))
+    writer.submit("UPDATE users SET age = age + 1 WHERE name = ?", ("Alice",))
+    print("Bob saved as rowid", saved.result())
+    print("duplicate:", duplicate.exception())
+
+# Someone else holding the write lock longer than busy_timeout only fails THAT batch, the writer keeps going
+with WriteBehind("people_wb.db", pragmas={"busy_timeout": 200}) as writer:
+    other = sqlite3.connect("people_wb.db", isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    print("while locked:", writer.submit("INSERT INTO users VALUES (?, ?)", ("Carol", 55)).exception())
+    other.execute("ROLLBACK")
+    other.close()
+    print("after:", writer.submit("INSERT INTO users VALUES (?, ?)", ("Carol", 55)).result())
+
+# A trigger doing RAISE(ROLLBACK) throws away the whole transaction, so nothing of that batch is saved, and all of it fails
+with sqlite3.connect("people_wb.db") as conn:
+    conn.execute("CREATE TRIGGER no_negative_age BEFORE INSERT ON users WHEN NEW.age < 0 "
+                 "BEGIN SELECT RAISE(ROLLBACK, 'age must not be negative'); END")
+conn.close()
+with WriteBehind("people_wb.db") as writer:
+    futures = [writer.submit("INSERT INTO users VALUES (?, ?)", (name, age))
+               for name, age in (("Dave", 40), ("Eve", -1), ("Frank", 20))]
+    print("rolled back:", [str(future.exception()) for future in futures])
+
+# A write cancelled before the writer got to it is never written, the rest of its batch is
+with WriteBehind("people_wb.db", flush_interval=1) as writer:
+    kept = writer.submit("INSERT INTO users VALUES (?, ?)", ("Grace", 33))
+    dropped = writer.submit("INSERT INTO users VALUES (?, ?)", ("Heidi", 44))
+    print("cancelled:", dropped.cancel())
+print("kept:", kept.result(), writer.stats)
+
+with sqlite3.connect("people_wb.db") as conn:
+    print(conn.execute("SELECT * FROM users").fetchall())
+conn.close()
+
+# Prints
+"""
+Bob saved as rowid 2
+duplicate: UNIQUE constraint failed: users.name
+while locked: database is locked
+after: 3
+rolled back: ['age must not be negative', 'age must not be negative', 'age must not be negative']
+cancelled: True
+kept: 4 WriteBehindStats(writes=1, failed=0, batches=1, avg_batch=1, commit_seconds=0.00)
+[('Alice', 31), ('Bob', 81), ('Carol', 55), ('Grace', 33)]
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 8 threads x 2000 inserts each
+    # The Chapter way (each thread has its own connection, execute + commit per row) vs. everyone submitting to one writer
+    THREADS, PER_THREAD = 8, 2000
+
+    def reset():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(bench_path("wb_bench.db") + suffix):
+                os.remove(bench_path("wb_bench.db") + suffix)
+        with sqlite3.connect(bench_path("wb_bench.db")) as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("CREATE TABLE events (thread INTEGER, n INTEGER)")
+        conn.close()
+
+    def run_threads(work):
+        threads = [threading.Thread(target=work, args=(t,)) for t in range(THREADS)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    reset()
+    errors = []
+
+    def commit_per_row(t):
+        conn = sqlite3.connect(bench_path("wb_bench.db"), timeout=1)
+        for n in range(PER_THREAD):
+            try:
+                conn.execute("INSERT INTO events VALUES (?, ?)", (t, n))
+                conn.commit()
+            except sqlite3.OperationalError as error:
+                errors.append(error)
+                conn.rollback()
+        conn.close()
+
+    elapsed = run_threads(commit_per_row)
+    print(f"commit per row   {THREADS * PER_THREAD / elapsed:>10,.0f} rows/s   errors: {len(errors)}")
+
+    reset()
+    writer = WriteBehind(bench_path("wb_bench.db"), flush_size=1000, flush_interval=0.05)
+
+    def write_behind(t):
+        for n in range(PER_THREAD):
+            writer.submit("INSERT INTO events VALUES (?, ?)", (t, n))
+
+    start = time.perf_counter()
+    submitted = run_threads(write_behind)
+    writer.close()                          # Waits for the last batch to commit
+    committed = time.perf_counter() - start
+    print(f"write behind     {THREADS * PER_THREAD / committed:>10,.0f} rows/s   errors: 0   "
+          f"(threads were done submitting after {submitted * 1000:.0f}ms)")
+    print(writer.stats)
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    commit per row       10,553 rows/s   errors: 2
+    write behind         39,879 rows/s   errors: 0   (threads were done submitting after 286ms)
+    WriteBehindStats(writes=16000, failed=0, batches=17, avg_batch=941, commit_seconds=0.16)
+    """
+    # 16,000 commits -> 17, and the write behind ones are synchronous=FULL (a real fsync each) while the commit per
+    # row ones are only NORMAL. Even with WAL and a fast disk, two threads still hit "database is locked" (timeout=1)
+    # On a laptop SSD (slower fsync) or with the default rollback journal, the commit per row number drops a lot further,
+    # the write behind one barely moves since it only commits a handful of times
+
+# Great for audit logs, event tracking, metrics, any "lots of threads writing little rows" workload
+
+# SQLite, caching query results
+# Dashboards, API endpoints, background jobs... the same SELECT with the same parameters gets asked over and over,
+# and SQLite re-runs it from scratch every time, even if nothing in the table has changed since the last one
+#
+# QueryCache sits in front of the pool:
+#   key = (normalized SQL, params)   "SELECT  *\n FROM users" and "SELECT * FROM users" are the same query
+#   (the normalized SQL is ONLY the key, SQLite always runs exactly the SQL the caller wrote)
+#   LRU, capped by number of entries AND by an estimate of how many bytes the cached rows take
+#   Every cached result remembers which tables it read from (FROM / JOIN)
+#   Writes go through the same object, and a write to "users" throws away every cached result that read "users"
+#   If we can't be SURE which tables a query reads (FROM a, b / main.users / "quoted" names / table functions),
+#   it's still cached, but tagged ANY, and ANY results get thrown away by every write, to any table
+#   A write that changed more rows than its own (triggers, ON DELETE CASCADE) clears the whole cache
+#   Anything that writes to the database WITHOUT going through here won't invalidate, so route writes through it
+#   Views hide their tables too: a query on a view won't see writes to the tables under it, call invalidate() for those
+#
+# Cached results come back as a tuple of rows, so one caller can't change what the next caller gets
+
+import collections
+import collections.abc
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+from functools import lru_cache
+
+_WHITESPACE_OR_STRING = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\s+")
+_TOKENS = re.compile(r"'(?:[^']|'')*'|[A-Za-z_]\w*|\S")
+_IDENTIFIER = re.compile(r"[A-Za-z_]\w*")
+_CLAUSE_ENDS = {"WHERE", "GROUP", "HAVING", "ORDER", "LIMIT", "WINDOW", "UNION", "EXCEPT", "INTERSECT", "RETURNING"}
+# \b(?!\s*\.) so "main.users" doesn't match as a table called "main", it doesn't match at all (= clear everything)
+_WRITE_TABLE = re.compile(r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+"
+                          r"([A-Za-z_]\w*)\b(?!\s*\.)", re.IGNORECASE)
+ANY = "*"       # Tag for results we don't know the tables of. Can't clash, a real table name here is always an identifier
+
+@lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    # Squash runs of whitespace to one space, but leave anything inside 'strings' and "quoted names" alone
+    return _WHITESPACE_OR_STRING.sub(lambda m: m.group() if m.group()[0] in "'\"" else " ", sql).strip()
+
+@lru_cache(maxsize=4096)
+def read_tables(sql):
+    # The plain table names after every FROM / JOIN, or None if the FROM clause has anything we can't read for sure
+    tokens = _TOKENS.findall(sql)
+    tables = set()
+    froms = []          # Paren depth of each FROM clause we're inside of, innermost last
+    depth = 0
+    for i, token in enumerate(tokens):
+        word = token.upper()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+            while froms and froms[-1] > depth:
+                froms.pop()
+        elif froms and froms[-1] == depth and (token == "," or word in _CLAUSE_ENDS):
+            if token == ",":
+                return None         # FROM a, b: the names after the comma aren't behind a FROM / JOIN
+            froms.pop()
+        elif word in ("FROM", "JOIN"):
+            name, after = (tokens[i + 1:i + 3] + ["", ""])[:2]
+            if name != "(":         # A subquery, its own FROM gets read when we get there
+                if not _IDENTIFIER.fullmatch(name) or after in (".", "("):
+                    return None     # "quoted", [bracketed], schema.table, table_function(...)
+                tables.add(name.lower())
+            if word == "FROM":
+                froms.append(depth)
+    return frozenset(tables)
+
+def result_size(rows):
+    # Rough bytes for a list of tuples: the containers + each value. Close enough to cap the cache with
+    return sys.getsizeof(rows) + sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in rows)
+
+
+class QueryCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0        # Entries thrown away because a table they read was written to
+        self.evicted = 0            # Entries thrown away to stay under maxsize / max_bytes
+        self.bytes_saved = 0        # Result bytes served from the cache instead of being rebuilt by SQLite
+
+    def __repr__(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0
+        return (f"QueryCacheStats(hits={self.hits}, misses={self.misses}, hit_rate={rate:.1%}, invalidated={self.invalidated}, "
+                f"evicted={self.evicted}, bytes_saved={self.bytes_saved / 1e6:.1f}MB)")
+
+
+class QueryCache:
+    def __init__(self, pool, maxsize=1024, max_bytes=64 * 1024 * 1024):
+        self.pool = pool
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()            # key -> (rows, nbytes, tables)
+        self.by_table = collections.defaultdict(set)        # table -> keys that read it
+        self.versions = collections.Counter()               # table -> how many writes it's had
+        self.generation = 0                                 # Bumped when the whole cache is cleared
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.stats = QueryCacheStats()
+
+    def query(self, sql, params=()):
+        # Named parameters come as a dict, and tuple() of that would only keep the names, not the values
+        params_key = tuple(sorted(params.items())) if isinstance(params, collections.abc.Mapping) else tuple(params)
+        key = (normalize_sql(sql), params_key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats.hits += 1
+                self.stats.bytes_saved += entry[1]
+                return entry[0]
+            self.stats.misses += 1
+            tables = read_tables(key[0])
+            tables = frozenset([ANY]) if tables is None else tables
+            before = (self.generation, [self.versions[table] for table in tables])
+        rows = tuple(self.pool.execute(sql, params))        # Run the query OUTSIDE the lock
+        with self.lock:
+            # If someone wrote to one of our tables while we were querying, this result might already be stale
+            if (self.generation, [self.versions[table] for table in tables]) == before:
+                self.store(key, rows, tables)
+        return rows
+
+    def store(self, key, rows, tables):
+        nbytes = result_size(rows)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.drop(key)
+        self.entries[key] = (rows, nbytes, tables)
+        self.nbytes += nbytes
+        for table in tables:
+            self.by_table[table].add(key)
+        while len(self.entries) > self.maxsize or self.nbytes > self.max_bytes:
+            self.drop(next(iter(self.entries)))             # Oldest = least recently used
+            self.stats.evicted += 1
+
+    def drop(self, key):
+        rows, nbytes, tables = self.entries.pop(key)
+        self.nbytes -= nbytes
+        for table in tables:
+            self.by_table[table].discard(key)
+
+    def execute(self, sql, params=()):
+        # Writes: run it, then forget everything that read the table it changed
+        # CREATE / DROP / ALTER and anything else we can't read a table name from clears the whole cache
+        with self.pool.transaction() as conn:
+            changes = conn.total_changes
+            cursor = conn.execute(sql, params)
+            # total_changes also counts rows changed by triggers and foreign key actions, rowcount doesn't
+            side_effects = conn.total_changes - changes > max(cursor.rowcount, 0)
+        match = _WRITE_TABLE.match(sql)
+        self.invalidate(match.group(1).lower() if match and not side_effects else None)
+        return cursor.rowcount
+
+    def invalidate(self, table=None):
+        with self.lock:
+            if table is None:
+                self.generation += 1                        # Makes every query still running count as stale too
+                self.stats.invalidated += len(self.entries)
+                self.entries.clear()
+                self.by_table.clear()
+                self.nbytes = 0
+                return
+            for name in (table, ANY):
+                self.versions[name] += 1
+                for key in list(self.by_table.pop(name, ())):
+                    self.drop(key)
+                    self.stats.invalidated += 1
+
+
+users = QueryCache(ConnectionPool("people.db", size=4))
+
+print(users.query("SELECT name, age FROM users WHERE name = ?", ("Alice",))[:1])
+print(users.query("SELECT name, age\n    FROM users\n   WHERE name = ?", ("Alice",))[:1])      # Same query, cache hit
+users.execute("UPDATE users SET age = age + 1 WHERE name = ?", ("Alice",))                  # Invalidates "users"
+print(users.query("SELECT name, age FROM users WHERE name = ?", ("Alice",))[:1])
+users.execute("UPDATE users SET age = age - 1 WHERE name = ?", ("Alice",))
+print(users.query("SELECT name, age FROM users WHERE name = :name", {"name": "Alice"})[:1])
+print(users.query("SELECT name, age FROM users WHERE name = :name", {"name": "Bob"})[:1])        # Not Alice's rows
+print(users.stats)
+users.pool.close()
+
+# Prints
+"""
+(('Alice', 30),)
+(('Alice', 30),)
+(('Alice', 31),)
+(('Alice', 30),)
+(('Bob', 81),)
+QueryCacheStats(hits=1, misses=4, hit_rate=20.0%, invalidated=2, evicted=0, bytes_saved=0.0MB)
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 5k reads over 500 different age range queries (a few of them are popular) on the 100k row patients table
+    # from the pool section. Every 20 reads someone logs a visit (a write to a DIFFERENT table, cached patients
+    # results survive it), every 500 reads a patient gets updated (that one does wipe the patients results)
+    random.seed(1)
+    queries = [("SELECT COUNT(*), AVG(age) FROM patients WHERE age BETWEEN ? AND ?", (low, low + random.randint(1, 20)))
+               for low in range(100) for _ in range(5)]
+    workload = [random.choice(queries[:50]) if random.random() < 0.8 else random.choice(queries) for _ in range(5000)]
+
+    def run(read, write):
+        start = time.perf_counter()
+        for i, (sql, params) in enumerate(workload):
+            read(sql, params)
+            if i % 20 == 0:
+                write("INSERT INTO visits VALUES (?, ?)", (i, "checkup"))
+            if i % 500 == 0:
+                write("UPDATE patients SET age = age WHERE id = ?", (i,))
+        return len(workload) / (time.perf_counter() - start)
+
+    bench_pool = ConnectionPool(bench_path("pool_bench.db"), size=4)
+    bench_pool.execute("CREATE TABLE IF NOT EXISTS visits (patient_id INTEGER, reason TEXT)")
+
+    def write_uncached(sql, params):
+        with bench_pool.transaction() as conn:
+            conn.execute(sql, params)
+
+    print(f"pool only     {run(bench_pool.execute, write_uncached):>10,.0f} queries/s")
+    cache = QueryCache(bench_pool)
+    print(f"QueryCache    {run(cache.query, cache.execute):>10,.0f} queries/s")
+    print(cache.stats)
+    bench_pool.close()
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    pool only            189 queries/s
+    QueryCache           735 queries/s
+    QueryCacheStats(hits=3791, misses=1209, hit_rate=75.8%, invalidated=1083, evicted=0, bytes_saved=0.6MB)
+    """
+    # A hit costs microseconds, a miss is a full scan of 100k rows, so speedup is basically 1 / (miss rate)
+    # The 250 visit inserts didn't throw anything away, the 10 patient updates are where the 1083 invalidations came from
+    # bytes_saved is small here because each answer is one row. Queries returning thousands of rows save a lot more
+
+# Great for dashboards, lookup tables, reports, any read-heavy endpoint that asks the same questions a lot
+
+# SQLite, full text search
+# WHERE name LIKE '%smi%' can't use an index (an index is sorted by the START of the text), so SQLite reads
+# every single row, every single search. 10x the rows = 10x slower
+#
+# FTS5 is SQLite's built in search engine. It keeps an "inverted index": word -> which rows contain it,
+# like the index in the back of a book. A search looks up the words instead of reading the table
+#   MATCH 'smith'            rows containing the word smith
+#   MATCH 'smi*'             prefix, words starting with smi   (prefix='2 3' pre-indexes 2 and 3 letter prefixes)
+#   MATCH '"main street"'    phrase, those words next to each other in that order
+#   ORDER BY rank            best match first (bm25, the same scoring idea most search engines use)
+#
+# FullTextIndex builds an FTS5 table that MIRRORS chosen columns of a normal table:
+#   content='users' -> the FTS table doesn't store a second copy of the text, it reads it from users when needed
+#   Triggers on users keep it in sync on INSERT / UPDATE / DELETE, so nobody has to remember to update it
+#   Rows that were already there before the triggers get indexed by catch_up(), a batch at a time,
+#   each batch its own short transaction. Can be stopped and resumed, and never locks the table for long
+
+import os
+import random
+import sqlite3
+import time
+
+
+def fts_quote(text):
+    # User text -> a safe FTS5 string, so a stray " or * or AND in a search box can't break the query
+    return '"' + text.replace('"', '""') + '"'
+
+def prefix_query(text, column=None):
+    # "ali main" -> "ali"* "main"*    every word has to match the start of some word in the row
+    # column="name" -> name : ("ali"* "main"*)    only look in that column
+    query = " ".join(fts_quote(word) + "*" for word in text.split())
+    return f"{column} : ({query})" if column else query
+
+def phrase_query(text, column=None):
+    # "main street" -> "main street"    those words, next to each other, in that order
+    query = fts_quote(text)
+    return f"{column} : {query}" if column else query
+
+
+class FullTextIndex:
+    def __init__(self, conn, table, columns, tokenize="unicode61 remove_diacritics 2", prefix="2 3"):
+        # table and columns are pasted into the SQL, so they come from our code, not from user input
+        self.conn = conn
+        self.table = table
+        self.columns = list(columns)
+        self.fts = f"{table}_fts"
+        self.tokenize = tokenize
+        self.prefix = prefix
+
+    def create(self):
+        cols = ", ".join(self.columns)
+        new = ", ".join(f"new.{c}" for c in self.columns)
+        old = ", ".join(f"old.{c}" for c in self.columns)
+        with self.conn:
+            self.conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.fts} USING fts5({cols}, content='{self.table}', "
+                              f"content_rowid='rowid', tokenize='{self.tokenize}', prefix='{self.prefix}')")
+            # Everything up to the current last rowid gets indexed by catch_up(), everything after by the triggers
+            self.conn.execute("CREATE TABLE IF NOT EXISTS fts_progress (fts TEXT PRIMARY KEY, done INTEGER, upto INTEGER)")
+            self.conn.execute(f"INSERT OR IGNORE INTO fts_progress SELECT ?, 0, COALESCE(MAX(rowid), 0) FROM {self.table}", (self.fts,))
+            # External content FTS tables are told what to forget with the special 'delete' command,
+            # which needs the OLD values of the columns
+            # Rows catch_up() hasn't got to yet (done < rowid <= upto) are left alone: a 'delete' for a row that was
+            # never indexed corrupts the index, and catch_up() will index whatever the row holds when it gets there
+            def indexed(rowid):
+                return (f"NOT EXISTS (SELECT 1 FROM fts_progress WHERE fts = '{self.fts}' "
+                        f"AND {rowid} > done AND {rowid} <= upto)")
+            # DROP + CREATE instead of IF NOT EXISTS, so a database made with older triggers gets these ones
+            self.conn.executescript(f"""
+                DROP TRIGGER IF EXISTS {self.fts}_ai;
+                DROP TRIGGER IF EXISTS {self.fts}_ad;
+                DROP TRIGGER IF EXISTS {self.fts}_au;
+                CREATE TRIGGER {self.fts}_ai AFTER INSERT ON {self.table} WHEN {indexed("new.rowid")} BEGIN
+                    INSERT INTO {self.fts}(rowid, {cols}) VALUES (new.rowid, {new});
+                END;
+                CREATE TRIGGER {self.fts}_ad AFTER DELETE ON {self.table} WHEN {indexed("old.rowid")} BEGIN
+                    INSERT INTO {self.fts}({self.fts}, rowid, {cols}) VALUES ('delete', old.rowid, {old});
+                END;
+                CREATE TRIGGER {self.fts}_au AFTER UPDATE OF {cols} ON {self.table} BEGIN
+                    INSERT INTO {self.fts}({self.fts}, rowid, {cols}) SELECT 'delete', old.rowid, {old} WHERE {indexed("old.rowid")};
+                    INSERT INTO {self.fts}(rowid, {cols}) SELECT new.rowid, {new} WHERE {indexed("new.rowid")};
+                END;
+            """)
+        return self
+
+    def catch_up(self, batch_size=100_000, max_batches=None):
+        # Indexes rows that existed before create(). Returns how many rows are still left to do
+        cols = ", ".join(self.columns)
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            done, upto = self.conn.execute("SELECT done, upto FROM fts_progress WHERE fts = ?", (self.fts,)).fetchone()
+            if done >= upto:
+                return 0
+            end = min(done + batch_size, upto)
+            with self.conn:
+                self.conn.execute(f"INSERT INTO {self.fts}(rowid, {cols}) SELECT rowid, {cols} FROM {self.table} "
+                                  f"WHERE rowid > ? AND rowid <= ?", (done, end))
+                self.conn.execute("UPDATE fts_progress SET done = ? WHERE fts = ?", (end, self.fts))
+            batches += 1
+        done, upto = self.conn.execute("SELECT done, upto FROM fts_progress WHERE fts = ?", (self.fts,)).fetchone()
+        return upto - done
+
+    def rebuild(self):
+        # Throw the whole index away and rebuild it from the table, if it ever gets out of sync
+        with self.conn:
+            self.conn.execute(f"INSERT INTO {self.fts}({self.fts}) VALUES ('rebuild')")
+            self.conn.execute("UPDATE fts_progress SET done = upto WHERE fts = ?", (self.fts,))
+
+    def optimize(self):
+        # Merge the index's internal pieces into one. Worth doing after a big catch_up or lots of updates
+        with self.conn:
+            self.conn.execute(f"INSERT INTO {self.fts}({self.fts}) VALUES ('optimize')")
+
+    def search(self, query, limit=20):
+        # query is FTS5 syntax, build it with prefix_query() / phrase_query() when it comes from a user
+        cols = ", ".join(f"t.{c}" for c in self.columns)
+        return self.conn.execute(f"SELECT t.rowid, {cols}, {self.fts}.rank FROM {self.fts} JOIN {self.table} t ON t.rowid = {self.fts}.rowid "
+                                 f"WHERE {self.fts} MATCH ? ORDER BY {self.fts}.rank LIMIT ?", (query, limit)).fetchall()
+
+
+if os.path.exists("people_fts.db"):
+    os.remove("people_fts.db")
+conn = sqlite3.connect("people_fts.db")
+conn.execute("CREATE TABLE users (name TEXT, address TEXT, age INTEGER)")
+conn.executemany("INSERT INTO users VALUES (?, ?, ?)", [("Alice Smith", "123 Main Street", 30), ("Bob Smithers", "9 Main Road", 81)])
+conn.commit()
+
+index = FullTextIndex(conn, "users", ["name", "address"]).create()
+print("left to index:", index.catch_up())
+with conn:
+    conn.execute("INSERT INTO users VALUES (?, ?, ?)", ("Carol Mainz", "42 Oak Avenue", 55))      # Trigger indexes it
+    conn.execute("UPDATE users SET address = ? WHERE name = ?", ("77 Elm Court", "Bob Smithers"))
+
+for rowid, name, address, rank in index.search(prefix_query("smi")):
+    print(rowid, name, address)
+print([row[1] for row in index.search(phrase_query("main street"))])
+print([row[1] for row in index.search(prefix_query("main"))])
+conn.close()
+
+# Prints
+"""
+left to index: 0
+1 Alice Smith 123 Main Street
+2 Bob Smithers 77 Elm Court
+['Alice Smith']
+['Alice Smith', 'Carol Mainz']
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 1M and 10M people, LIKE vs. FTS. The LIKE time grows with the table,
+    # the FTS time depends on how many rows MATCH, not how many rows there are
+    random.seed(1)
+    first = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank", "Grace", "Heidi", "Ivan", "Judy"]
+    syllables = ["ka", "lo", "mi", "ser", "tan", "vo", "ber", "ri", "don", "wel", "ha", "gen"]
+    surnames = sorted({"".join(random.choices(syllables, k=4)).capitalize() for _ in range(30_000)})
+    streets = [f"{random.choice(surnames)} {kind}" for kind in ("Street", "Road", "Avenue", "Court") for _ in range(500)]
+    surname = surnames[1234]
+    street = streets[17]
+
+    for rows, label in [(1_000_000, "1M"), (10_000_000, "10M")]:
+        print(f"{label} rows")
+        path = bench_path(f"fts_bench_{label}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE patients (name TEXT, address TEXT, age INTEGER)")
+        with conn:
+            conn.executemany("INSERT INTO patients VALUES (?, ?, ?)",
+                             ((f"{random.choice(first)} {random.choice(surnames)}", f"{random.randint(1, 99)} {random.choice(streets)}",
+                               random.randint(0, 100)) for _ in range(rows)))
+
+        start = time.perf_counter()
+        index = FullTextIndex(conn, "patients", ["name", "address"]).create()
+        index.catch_up()
+        index.optimize()
+        print(f"  indexed {label} existing rows in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        with conn:
+            conn.executemany("INSERT INTO patients VALUES (?, ?, ?)", [("Zed Kalomiser", "1 Nowhere Lane", 40)] * 10_000)
+        print(f"  10k inserts with the triggers keeping the index in sync: {time.perf_counter() - start:.2f}s")
+
+        searches = [
+            ("surname prefix", "SELECT rowid, name, address FROM patients WHERE name LIKE ?", (f"% {surname[:7]}%",), prefix_query(surname[:7], "name")),
+            ("address phrase", "SELECT rowid, name, address FROM patients WHERE address LIKE ?", (f"% {street}%",), phrase_query(street, "address")),
+        ]
+        for search, like_sql, like_params, fts_query in searches:
+            start = time.perf_counter()
+            for _ in range(5):
+                like_rows = conn.execute(like_sql, like_params).fetchall()
+            like_ms = (time.perf_counter() - start) / 5 * 1000
+            start = time.perf_counter()
+            for _ in range(5):
+                fts_rows = index.search(fts_query, limit=100_000)
+            fts_ms = (time.perf_counter() - start) / 5 * 1000
+            print(f"  {search:<16} LIKE {like_ms:7.1f} ms ({len(like_rows)} rows)   FTS {fts_ms:5.1f} ms ({len(fts_rows)} rows, ranked)")
+        conn.close()
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    1M rows
+      indexed 1M existing rows in 8.2s
+      10k inserts with the triggers keeping the index in sync: 1.18s
+      surname prefix   LIKE   152.2 ms (517 rows)   FTS   6.2 ms (517 rows, ranked)
+      address phrase   LIKE   131.2 ms (481 rows)   FTS   7.2 ms (481 rows, ranked)
+    10M rows
+      indexed 10M existing rows in 106.7s
+      10k inserts with the triggers keeping the index in sync: 1.22s
+      surname prefix   LIKE  1388.4 ms (4991 rows)   FTS  59.0 ms (4991 rows, ranked)
+      address phrase   LIKE  1645.7 ms (4944 rows)   FTS 132.7 ms (4944 rows, ranked)
+    """
+    # Same rows back, 12-25x faster at both sizes, and FTS hands them back best match first
+    # 10x the rows: LIKE is ~10x slower because it reads every row. FTS is 10-18x slower too, but that is
+    # because 10x as many rows match (and get ranked), the random names here repeat more at 10M
+    # The cost moves to writes: the first index build (~107s at 10M), then the triggers on every insert,
+    # which cost about the same at 1M and 10M
+
+# Great for patient/provider lookup boxes, searching notes, address search, anything where people type part of a name
+
 # INI/ConfigParser
 
 import configparser
@@ -353,6 +2906,542 @@ config.read("settings.ini")
 print(config["User"]["name"])
 
 
+# Config, parse once
+# Every short script re-parses its config at startup, and config["User"]["name"] on a ConfigParser isn't a plain
+# dict lookup: it goes through a SectionProxy and runs %(interpolation)s every single time. Inside a loop, that adds up
+#
+# load_config() turns INI / JSON / YAML into one frozen, typed snapshot:
+#   INI values get real types: "30" -> 30, "true" -> True, "2.5" -> 2.5 (JSON/YAML already have them)
+#   Only plain decimal numbers (30, -5, 2.5, 1e3) count: "007", "0123", "+15551234", "1_000", "nan", "Infinity"
+#   stay strings. Zip codes, phone numbers and account ids aren't numbers, they just look like them
+#   Sections/dicts become read only mappings and lists become tuples, so nothing can change the config by accident
+#   The parsed result is saved to a cache file keyed by the config's path + mtime + size. Next startup, if the config
+#   file hasn't changed, we just unpickle the cache, no INI/YAML parsing at all (and the parser never even gets imported)
+#   Unpickling runs code, so the cache lives in a folder only we can write to (~/.cache/config_cache, mode 700),
+#   never a shared one like /tmp. If the folder is someone else's or others can write to it, the cache is skipped
+# LiveConfig.reload_if_changed() is for daemons: one os.stat() call, and a reload only if the file actually changed
+
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import stat
+import tempfile
+import time
+from types import MappingProxyType
+
+try:
+    import yaml     # pip install pyyaml, only needed for .yaml / .yml files
+except ImportError:
+    yaml = None
+
+CONFIG_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "config_cache")
+_INT = re.compile(r"-?(?:0|[1-9][0-9]*)")
+_FLOAT = re.compile(r"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+(?:[eE][-+]?[0-9]+)?|[eE][-+]?[0-9]+)")
+
+
+def coerce(text):
+    # INI values are always strings, give them their real type
+    # int() / float() alone would also take "007", "+1555", "1_000", "nan", "inf"... and lose what was written
+    lowered = text.strip().lower()
+    if lowered in ("true", "yes", "on"):
+        return True
+    if lowered in ("false", "no", "off"):
+        return False
+    if _INT.fullmatch(text):
+        return int(text)
+    if _FLOAT.fullmatch(text):
+        return float(text)
+    return text
+
+def parse_config(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".ini", ".cfg"):
+        import configparser
+        parser = configparser.ConfigParser()
+        with open(path) as f:
+            parser.read_file(f)
+        # items() resolves %(interpolation)s and DEFAULT values once, here, instead of on every lookup
+        return {section: {key: coerce(value) for key, value in parser.items(section)} for section in parser.sections()}
+    if extension == ".json":
+        import json
+        with open(path) as f:
+            return json.load(f)
+    if extension in (".yaml", ".yml"):
+        if yaml is None:
+            raise RuntimeError(f"{path} is YAML, run: pip install pyyaml")
+        with open(path) as f:
+            return yaml.safe_load(f)
+    raise ValueError(f"Don't know how to read {path}")
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def file_key(path):
+    info = os.stat(path)
+    return info.st_mtime_ns, info.st_size
+
+def private_dir(path):
+    # Make path (only we can read/write it) if it's missing. False if it's not safe to unpickle from
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name != "posix":
+        return True         # Windows: the per-user profile folder is already private
+    info = os.lstat(path)
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+def load_config(path, cache_dir=CONFIG_CACHE_DIR):
+    path = os.path.abspath(path)
+    key = file_key(path)
+    try:
+        cache_ok = private_dir(cache_dir)
+    except OSError:
+        cache_ok = False        # Read only home, no home at all... just parse every time
+    if not cache_ok:
+        return freeze(parse_config(path))
+    cache_path = os.path.join(cache_dir, hashlib.sha256(path.encode()).hexdigest()[:24] + ".pickle")
+    try:
+        with open(cache_path, "rb") as f:
+            cached_path, cached_key, data = pickle.load(f)
+        if cached_path == path and cached_key == key:
+            return freeze(data)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, TypeError, AttributeError, IndexError, ImportError):
+        # No cache yet, or it's broken: a truncated or corrupt pickle, or one from an older version of this code
+        # naming a class or module that's gone. Just parse
+        pass
+    data = parse_config(path)
+    tmp = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump((path, key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache_path)         # Atomic, two scripts starting at once can't read half a cache file
+    return freeze(data)
+
+
+class LiveConfig:
+    def __init__(self, path, cache_dir=CONFIG_CACHE_DIR, min_interval=1.0):
+        # min_interval: don't even stat() the file more often than this
+        self.path = path
+        self.cache_dir = cache_dir
+        self.min_interval = min_interval
+        self.key = file_key(path)
+        self.snapshot = load_config(path, cache_dir)
+        self.checked = time.monotonic()
+
+    def __getitem__(self, name):
+        return self.snapshot[name]
+
+    def reload_if_changed(self):
+        # Returns True if the config changed and the snapshot was replaced
+        now = time.monotonic()
+        if now - self.checked < self.min_interval:
+            return False
+        self.checked = now
+        try:
+            key = file_key(self.path)
+        except FileNotFoundError:
+            return False        # Mid save by an editor, keep the last good snapshot
+        if key == self.key:
+            return False
+        try:
+            # Swapping one reference is atomic, so threads see either the whole old snapshot or the whole new one
+            self.snapshot = load_config(self.path, self.cache_dir)
+        except Exception:
+            return False        # Half written or broken file, keep running on the last good snapshot
+        self.key = key
+        return True
+
+
+config = load_config("settings.ini")
+print(config["User"]["name"], dict(config["User"]))
+try:
+    config["User"]["name"] = "Mallory"
+except TypeError as error:
+    print("read only:", error)
+
+# Editing a copy in a temp folder (its cache too), so settings.ini next to these notes stays as it is
+with tempfile.TemporaryDirectory() as folder:
+    live_path = os.path.join(folder, "settings.ini")
+    shutil.copyfile("settings.ini", live_path)
+    live = LiveConfig(live_path, cache_dir=os.path.join(folder, "cache"), min_interval=0)
+    print(live.reload_if_changed())
+    with open(live_path, "a") as f:
+        f.write("[Limits]\nmax_rows = 5000\nratio = 0.25\ndry_run = yes\nzip = 02134\n")
+    print(live.reload_if_changed(), dict(live["Limits"]))
+
+# Prints
+"""
+Alice {'name': 'Alice', 'role': 'Admin'}
+read only: 'mappingproxy' object does not support item assignment
+False
+True {'max_rows': 5000, 'ratio': 0.25, 'dry_run': True, 'zip': '02134'}
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: a bigger config (200 sections x 20 keys) as INI and JSON
+    # Startup = parse from scratch vs. load from the cache, then 1M lookups: ConfigParser vs. the snapshot
+    # (imported here just to BUILD the test files, load_config itself only imports a parser on a cache miss)
+    import configparser
+    import json
+
+    big = {f"service_{s}": {f"option_{k}": (k * s if k % 3 else f"value {k}") for k in range(20)} for s in range(200)}
+    big_ini = configparser.ConfigParser()
+    big_ini.read_dict(big)
+    with open(bench_path("big_settings.ini"), "w") as f:
+        big_ini.write(f)
+    with open(bench_path("big_settings.json"), "w") as f:
+        json.dump(big, f)
+
+    for path in (bench_path("big_settings.ini"), bench_path("big_settings.json")):
+        start = time.perf_counter()
+        for _ in range(20):
+            freeze(parse_config(path))
+        parse_ms = (time.perf_counter() - start) / 20 * 1000
+        load_config(path)       # Makes sure the cache file exists
+        start = time.perf_counter()
+        for _ in range(20):
+            load_config(path)
+        cached_ms = (time.perf_counter() - start) / 20 * 1000
+        print(f"{os.path.basename(path):<20} parse {parse_ms:6.2f} ms   cached {cached_ms:5.2f} ms")
+
+    start = time.perf_counter()
+    for _ in range(1_000_000):
+        big_ini["service_7"]["option_4"]
+    print(f"ConfigParser lookup   {(time.perf_counter() - start) * 1000:6.0f} ns")
+
+    snapshot = load_config(bench_path("big_settings.ini"))
+    start = time.perf_counter()
+    for _ in range(1_000_000):
+        snapshot["service_7"]["option_4"]
+    print(f"snapshot lookup       {(time.perf_counter() - start) * 1000:6.0f} ns")
+
+    live = LiveConfig(bench_path("big_settings.ini"))
+    start = time.perf_counter()
+    for _ in range(1_000_000):
+        live.reload_if_changed()
+    print(f"reload_if_changed     {(time.perf_counter() - start) * 1000:6.0f} ns (unchanged file)")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    big_settings.ini     parse  48.81 ms   cached  2.52 ms
+    big_settings.json    parse   2.85 ms   cached  2.09 ms
+    ConfigParser lookup     5060 ns
+    snapshot lookup           98 ns
+    reload_if_changed        191 ns (unchanged file)
+    """
+    # INI: ~20x faster startup. JSON's parser is already C, so the cache barely helps there (most of the 2ms is freeze())
+    # YAML is the big one: pyyaml's pure Python parser is usually slower than configparser, and the cache skips it entirely
+    # The lookup is ~50x cheaper, and reload_if_changed() with the default min_interval is basically free to call every loop
+
+# Great for CLI tools, cron scripts, daemons, anything that starts up a lot or reads settings in a hot loop
+
+# Compressed files, read directly
+# Archived inputs are usually .gz / .bz2 / .xz. Decompressing to disk first means writing the whole big file out
+# and reading it back in again, twice the I/O, and the parser can't start until the decompress is done
+#
+# open_any() is a drop in for open(path) / open(path, "rb"):
+#   Picks the codec from the first few bytes of the file (the "magic number"), not the extension, so a .gz
+#   renamed to .dat still works, and a plain file just gets plain open()
+#   Decompresses in a BACKGROUND thread into a small queue of chunks. zlib/bz2/lzma let go of the GIL while they
+#   work, so the decompressing and our Python parsing (csv.reader, json, ...) actually run at the same time
+#   gzip and bz2 files can be several complete compressed "members" glued together (pigz / pbzip2 / write_members()
+#   below make those). Each member can be decompressed on its own, so those get spread over a thread pool
+#   xz can't be split like that from Python, it gets the background thread only
+#
+# Finding member boundaries: search for each codec's header bytes. Compressed data can contain those bytes by chance,
+# so every guess gets checked: a piece only counts if it decompresses cleanly and ends EXACTLY where the next
+# piece starts. If a guess was wrong we just fall back to decompressing that part of the file in order
+
+import bz2
+import collections
+import concurrent.futures
+import csv
+import gzip
+import io
+import lzma
+import mmap
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import traceback
+import zlib
+
+CODECS = {
+    # name: (magic bytes, make a decompressor, pattern for the start of a member or None if members can't be split)
+    "gzip": (b"\x1f\x8b", lambda: zlib.decompressobj(wbits=31), re.compile(rb"\x1f\x8b\x08")),
+    "bz2": (b"BZh", bz2.BZ2Decompressor, re.compile(rb"BZh[1-9]1AY&SY")),
+    "xz": (b"\xfd7zXZ\x00", lzma.LZMADecompressor, None),
+}
+
+def detect_codec(path):
+    with open(path, "rb") as f:
+        head = f.read(8)
+    for name, (magic, _, _) in CODECS.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def only_padding(data):
+    # Tape drives and some archivers pad the file out to a whole block with NUL bytes after the last member
+    # gzip / gzip.open ignore those, so we do too. any() stops at the first non zero byte, so a real member is quick
+    return not any(data)
+
+def decompress_piece(data, make_decompressor):
+    # Decompress every member in data. ok=False if data ends in the middle of a member (a wrong boundary guess)
+    chunks = []
+    position = 0
+    try:
+        while position < len(data) and not only_padding(data[position:]):
+            decompressor = make_decompressor()
+            chunks.append(decompressor.decompress(data[position:]))
+            if not decompressor.eof:
+                return chunks, False
+            position = len(data) - len(decompressor.unused_data)
+    except (OSError, EOFError, zlib.error, lzma.LZMAError):
+        return chunks, False
+    return chunks, True
+
+def stream_sequential(data, make_decompressor, chunk_size):
+    # Plain in-order decompression, member after member, a chunk of input at a time
+    position = 0
+    while position < len(data) and not only_padding(data[position:]):
+        decompressor = make_decompressor()
+        while not decompressor.eof:
+            if position >= len(data):
+                raise EOFError("Compressed file ended before the end of the data")
+            block = data[position:position + chunk_size]
+            position += len(block)
+            yield decompressor.decompress(block)
+        position -= len(decompressor.unused_data)
+
+def stream_members(data, make_decompressor, pattern, pool, piece_bytes, max_pending, chunk_size):
+    # Guess boundaries, group them into pieces of about piece_bytes, decompress pieces in parallel, yield in order
+    starts = [0]
+    for match in pattern.finditer(data):
+        if match.start() - starts[-1] >= piece_bytes:
+            starts.append(match.start())
+    ends = starts[1:] + [len(data)]
+    pieces = iter(zip(starts, ends))
+    pending = collections.deque()
+
+    def fill():
+        while len(pending) < max_pending:
+            piece = next(pieces, None)
+            if piece is None:
+                return
+            pending.append((piece[0], pool.submit(decompress_piece, data[piece[0]:piece[1]], make_decompressor)))
+
+    fill()
+    while pending:
+        start, future = pending.popleft()
+        chunks, ok = future.result()
+        if not ok:
+            # A wrong guess. start is a real boundary (everything before it checked out), so go in order from there
+            for _, later in pending:
+                later.cancel()
+            yield from stream_sequential(data[start:], make_decompressor, chunk_size)
+            return
+        fill()
+        yield from chunks
+
+
+class ChunkReader(io.RawIOBase):
+    # Turns "a queue of bytes chunks" into a file object, so BufferedReader / TextIOWrapper can sit on top
+    def __init__(self, chunks, on_close):
+        self.chunks = chunks
+        self.on_close = on_close
+        self.leftover = b""
+        self.error = None       # Once the producer failed, every read raises that again (nothing more is coming)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.leftover:
+            if self.error is not None:
+                raise self.error
+            chunk = self.chunks.get()
+            if chunk is None:
+                return 0
+            if isinstance(chunk, BaseException):
+                self.error = chunk
+                raise chunk
+            self.leftover = memoryview(chunk)
+        size = min(len(buffer), len(self.leftover))
+        buffer[:size] = self.leftover[:size]
+        self.leftover = self.leftover[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.on_close()
+        super().close()
+
+
+def open_any(path, mode="r", encoding=None, errors=None, newline=None, threads=None, piece_bytes=4 * 1024 * 1024,
+             chunk_size=1024 * 1024, prefetch=8):
+    if mode not in ("r", "rt", "rb"):
+        raise ValueError("open_any only reads, mode must be 'r', 'rt' or 'rb'")
+    codec = detect_codec(path)
+    if codec is None:
+        return open(path, mode, encoding=encoding, errors=errors, newline=newline) if mode != "rb" else open(path, "rb")
+    _, make_decompressor, pattern = CODECS[codec]
+    threads = threads or min(4, os.cpu_count() or 1)
+
+    f = open(path, "rb")
+    mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+    data = memoryview(mapping) if mapping is not None else memoryview(b"")
+    chunks = queue.Queue(maxsize=prefetch)      # Backpressure: the decompressor can only get prefetch chunks ahead
+    stop = threading.Event()
+
+    def produce():
+        pool = concurrent.futures.ThreadPoolExecutor(threads) if pattern is not None and threads > 1 else None
+        try:
+            if pool is not None:
+                source = stream_members(data, make_decompressor, pattern, pool, piece_bytes, threads * 2, chunk_size)
+            else:
+                source = stream_sequential(data, make_decompressor, chunk_size)
+            for chunk in source:
+                if stop.is_set():
+                    return
+                if chunk:
+                    chunks.put(chunk)
+            chunks.put(None)
+        except Exception as error:
+            # Re-raised in the reading thread, on its next read. The frames in the traceback still hold slices of data,
+            # drop their locals so close() can unmap the file
+            traceback.clear_frames(error.__traceback__)
+            chunks.put(error)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+    producer = threading.Thread(target=produce, daemon=True)
+
+    def close():
+        stop.set()
+        while producer.is_alive():      # Unblock the producer if it's waiting on a full queue
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                producer.join(0.01)
+        data.release()
+        if mapping is not None:
+            mapping.close()
+        f.close()
+
+    producer.start()
+    raw = io.BufferedReader(ChunkReader(chunks, close), buffer_size=chunk_size)
+    if mode == "rb":
+        return raw
+    return io.TextIOWrapper(raw, encoding=encoding or "utf-8", errors=errors, newline=newline)
+
+
+def write_members(source, destination, codec="gzip", member_bytes=4 * 1024 * 1024):
+    # Compress source as a series of independent members (like pigz / pbzip2 do) so open_any can use every core
+    compress = {"gzip": gzip.compress, "bz2": bz2.compress, "xz": lzma.compress}[codec]
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        while block := src.read(member_bytes):
+            dst.write(compress(block))
+
+
+with open("people.csv", "rb") as src, gzip.open("people.csv.gz", "wb") as dst:
+    shutil.copyfileobj(src, dst)
+
+print(detect_codec("people.csv.gz"), detect_codec("people.csv"))
+with open_any("people.csv.gz", newline="") as f:
+    for row in csv.DictReader(f):
+        print(row["name"], row["dob"])
+
+# Prints
+"""
+gzip None
+Alice 02-14-1990
+Bob 07-16-1943
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: ~70MB CSV (people_big.csv from the columnar section, 4 times), count rows with csv.reader
+    #   decompress to disk first -> then read the plain file (what we do today)
+    #   stdlib X.open()          -> streaming, but decompressing and parsing take turns on one thread
+    #   open_any                 -> background thread (one normal single member file)
+    #   open_any, members        -> same data written with write_members(), thread pool
+    with open(bench_path("people_big.csv"), "rb") as src, open(bench_path("archive.csv"), "wb") as dst:
+        for _ in range(4):
+            src.seek(0)
+            shutil.copyfileobj(src, dst)
+    size = os.path.getsize(bench_path("archive.csv"))
+
+    def count_rows(f):
+        return sum(1 for _ in csv.reader(f))
+
+    openers = {"gzip": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+    for codec, extension in [("gzip", "gz"), ("bz2", "bz2"), ("xz", "xz")]:
+        with open(bench_path("archive.csv"), "rb") as src, openers[codec](bench_path(f"archive.csv.{extension}"), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        write_members(bench_path("archive.csv"), bench_path(f"archive_members.csv.{extension}"), codec)
+
+        def to_disk_first():
+            with openers[codec](bench_path(f"archive.csv.{extension}"), "rb") as src, open(bench_path("archive_out.csv"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            with open(bench_path("archive_out.csv"), newline="") as f:
+                return count_rows(f)
+
+        def stdlib_open():
+            with openers[codec](bench_path(f"archive.csv.{extension}"), "rt", newline="") as f:
+                return count_rows(f)
+
+        def with_open_any():
+            with open_any(bench_path(f"archive.csv.{extension}"), newline="") as f:
+                return count_rows(f)
+
+        def with_open_any_members():
+            with open_any(bench_path(f"archive_members.csv.{extension}"), newline="", threads=4) as f:
+                return count_rows(f)
+
+        for label, func in [("to disk first", to_disk_first), (f"{codec}.open", stdlib_open), ("open_any", with_open_any),
+                            ("open_any, members", with_open_any_members)]:
+            if codec == "xz" and label == "open_any, members":
+                continue        # Same as plain open_any, xz members can't be split from Python
+            start = time.perf_counter()
+            rows = func()
+            elapsed = time.perf_counter() - start
+            print(f"{codec:<5} {label:<20}{size / elapsed / 1e6:>8.1f} MB/s   {rows:,} rows")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    gzip  to disk first           47.9 MB/s   2,000,004 rows
+    gzip  gzip.open               40.3 MB/s   2,000,004 rows
+    gzip  open_any                34.9 MB/s   2,000,004 rows
+    gzip  open_any, members       34.8 MB/s   2,000,004 rows
+    bz2   to disk first           16.6 MB/s   2,000,004 rows
+    bz2   bz2.open                14.3 MB/s   2,000,004 rows
+    bz2   open_any                13.8 MB/s   2,000,004 rows
+    bz2   open_any, members        9.8 MB/s   2,000,004 rows
+    xz    to disk first           23.0 MB/s   2,000,004 rows
+    xz    xz.open                 22.1 MB/s   2,000,004 rows
+    xz    open_any                23.0 MB/s   2,000,004 rows
+    """
+    # Numbers from a 1 core box, so there's nothing to overlap WITH: every thread takes turns on the same core, and the
+    # queue handoff (plus 4 pool threads fighting over that 1 core for the members) is pure overhead
+    # With 2+ cores the background thread hides most of the decompress time behind csv.reader,
+    # and members spread bz2 (the slowest codec by far) over every core
+    # "to disk first" looks fine here only because the 70MB file stays in the OS cache. On a real disk with GBs of
+    # input, writing it out and reading it back is the part that hurts, and it also needs the free space
+
+# Great for archived extracts, rotated logs (.gz), vendor drops, anything that shows up compressed
+
+
 ''' Advanced Notes:
 
 Python iterable = "A thing you can loop over that knows how to give you one item at a time"
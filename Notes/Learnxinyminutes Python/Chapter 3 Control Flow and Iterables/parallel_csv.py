@@ -0,0 +1,156 @@
+# CSV on every core
+# The code for the "CSV on every core" section of Control Flow and Iterables.py, the notes there explain how it works
+#
+# It's its own file because of how worker processes start on Windows and macOS ("spawn"): each worker runs the
+# main script again from the top before it does any work. Here that's just these function definitions, the
+# example and benchmark are behind the __main__ guard. Anything that imports parallel_csv needs the same guard
+# around its own top level code
+#
+#     python parallel_csv.py        runs the example + the benchmark
+
+import collections
+import concurrent.futures
+import csv
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+
+def find_ranges(path, chunk_bytes=64 * 1024 * 1024, block_size=1024 * 1024):
+    # Yields (start, end) byte offsets. Every range starts at the beginning of a row. Skips the header row
+    # Only for RFC 4180 style CSV (what csv.writer makes): a " only ever opens/closes a quoted field or is doubled
+    # inside one. A bare " in an unquoted field (5'10" tall) flips odd/even, and every cut after it lands mid row
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.readline()            # Header
+        start = position = f.tell()
+        target = start + chunk_bytes
+        odd_quotes = 0          # 1 if we're inside a quoted field at the start of the current block
+        while block := f.read(block_size):
+            while target < position + len(block):
+                newline = block.find(b"\n", max(0, target - position))
+                while newline != -1 and (odd_quotes + block.count(b'"', 0, newline)) % 2:
+                    newline = block.find(b"\n", newline + 1)     # Newline inside quotes, keep looking
+                if newline == -1:
+                    target = position + len(block)      # No safe spot left in this block, try the next one
+                    break
+                end = position + newline + 1
+                yield start, end
+                start, target = end, end + chunk_bytes
+            odd_quotes = (odd_quotes + block.count(b'"')) % 2
+            position += len(block)
+    if start < size:
+        yield start, size
+
+
+def parse_range(path, start, end, func, encoding="utf-8"):
+    # Runs inside a worker process
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding)
+    rows = list(csv.reader(io.StringIO(text, newline="")))
+    return func(rows) if func is not None else rows
+
+
+def parallel_csv(path, func=None, workers=None, chunk_bytes=64 * 1024 * 1024, ordered=True, max_pending=None,
+                 encoding="utf-8"):
+    # func gets a list of rows and runs IN THE WORKER. Reduce there (count, sum, filter) and only the small
+    # result comes back. Sending millions of rows back to the parent would cost more than parsing them
+    # func has to be a normal top level function, worker processes receive it by pickling its name
+    # encoding: utf-8, latin-1, cp1252... The cut points are found in the raw bytes, so " and newline have to be
+    # the plain one byte ASCII values. UTF-16 / UTF-32 files can't be split this way
+    if b'"\n'.decode(encoding, errors="replace") != '"\n':
+        raise ValueError(f"parallel_csv can't split {encoding} files, \" and newline aren't single ASCII bytes in it")
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or workers * 2
+    ranges = find_ranges(path, chunk_bytes)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+
+        def fill():
+            while len(pending) < max_pending:
+                next_range = next(ranges, None)
+                if next_range is None:
+                    return
+                pending.append(pool.submit(parse_range, path, *next_range, func, encoding))
+
+        fill()
+        while pending:
+            if ordered:
+                future = pending.popleft()      # Wait on the oldest chunk so results come out in file order
+            else:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            result = future.result()
+            fill()                              # A slot opened up, submit the next chunk BEFORE handing back the result
+            yield result
+
+
+def count_and_sum_ages(rows):
+    return len(rows), sum(int(row[3]) for row in rows)
+
+
+if __name__ == "__main__":
+    folder = tempfile.mkdtemp(prefix="parallel_csv_")      # Test files go here, not next to the notes
+    try:
+        # Quoted newlines land exactly on the cut points and still come out right
+        tricky = os.path.join(folder, "tricky.csv")
+        with open(tricky, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "dob", "address"])
+            for i in range(10_000):
+                writer.writerow([f"Person {i}", "02-14-1990", f"{i} Main Street\nApt {i % 7}\n\"Back\" door"])
+
+        with open(tricky, newline="") as f:
+            expected = list(csv.reader(f))[1:]
+        chunks = list(parallel_csv(tricky, chunk_bytes=4096, workers=2))
+        print(len(chunks), "chunks, same rows as csv.reader:", [row for chunk in chunks for row in chunk] == expected)
+
+        # Prints
+        # 152 chunks, same rows as csv.reader: True
+
+
+        # Benchmark: 500k rows shaped like people.csv (name, dob, address, age), count rows + sum ages
+        people = os.path.join(folder, "people_big.csv")
+        with open(people, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["name", "dob", "address", "age"])
+            names = ["Alice", "Bob", "Carol", "Dave", "Eve", "Frank"]
+            streets = ["Main Street", "Side Road", "Oak Avenue", "Elm Court"]
+            for i in range(500_000):
+                writer.writerow([random.choice(names), f"{random.randint(1, 12):02}-{random.randint(1, 28):02}-{random.randint(1930, 2020)}",
+                                 f"{random.randint(1, 999)} {random.choice(streets)}", random.randint(0, 100)])
+
+        start = time.perf_counter()
+        rows = ages = 0
+        with open(people, newline="") as f:
+            reader = csv.reader(f)
+            next(reader)
+            for row in reader:
+                rows += 1
+                ages += int(row[3])
+        print(f"csv.reader, 1 core     {rows / (time.perf_counter() - start):>12,.0f} rows/s")
+
+        for workers in (1, 2, 4):
+            start = time.perf_counter()
+            rows = ages = 0
+            for chunk_rows, chunk_ages in parallel_csv(people, count_and_sum_ages, workers=workers, chunk_bytes=1024 * 1024, ordered=False):
+                rows += chunk_rows
+                ages += chunk_ages
+            print(f"parallel, {workers} workers   {rows / (time.perf_counter() - start):>12,.0f} rows/s")
+
+        # Prints (numbers from a 1 core box, so this only shows the overhead, not the speedup)
+        """
+        csv.reader, 1 core          761,223 rows/s
+        parallel, 1 workers        681,028 rows/s
+        parallel, 2 workers        663,624 rows/s
+        parallel, 4 workers        622,651 rows/s
+        """
+        # With 1 core, extra workers just take turns and the pickling/process startup is pure cost
+        # Each worker is independent (own process, own slice of the file, tiny result), so on an N core machine
+        # it's close to N times the 1 worker number until the disk can't keep up
+    finally:
+        shutil.rmtree(folder)
@@ -3,6 +3,22 @@
     Decorators
 """
 
+# The "Benchmark" parts further down call things hundreds of thousands of times and take a while all together,
+# so running these notes top to bottom skips them. To run them too:
+#     RUN_BENCHMARKS=1 python Decorators.py
+# Everything they write goes in one temp folder (the path gets printed), never next to these notes
+import os
+import tempfile
+
+RUN_BENCHMARKS = os.environ.get("RUN_BENCHMARKS") == "1"
+BENCH_DIR = tempfile.mkdtemp(prefix="notes_bench_") if RUN_BENCHMARKS else None
+if RUN_BENCHMARKS:
+    print("Benchmark files go in", BENCH_DIR)
+
+def bench_path(name):
+    return os.path.join(BENCH_DIR, name)
+
+
 # What is a decorator?
 #   A decorator is a function that takes another function, adds behavior, and returns a new function
 
@@ -78,13 +94,221 @@ def add(a, b):
 add(3, 5)
 
 # Prints
+"""
 [LOG] Calling add with args=(3, 5), kwargs={}
 [LOG] add returned 8
+"""
 
 # Great for debugging automation flows, tracing EMR actions, and monitoring scripts
 
 
 
+# Logging, the grown up version
+# The log_calls above does ALL its work on every call, even if nobody ever reads the output:
+#   builds two f-strings (repr of every arg, including that 50MB list someone passed in)
+#   print()s twice, and print is slow, it waits on the terminal/file
+# Fine for debugging, not fine for something we want to leave on while tracing EMR actions
+#
+# The fixes:
+#   levels instead of print   -> one cheap "is tracing on at this level?" check, turned off = almost free
+#   lazy formatting           -> hand logging the raw args with "%s" placeholders. It only builds the string
+#                                if the record actually gets written somewhere
+#   QueueListener             -> the calling thread just drops a tuple on a queue and moves on.
+#                                A background thread builds the LogRecord, formats it and does the slow writing
+#   sampling + rate limit     -> log 1 in N calls, and never more than X per second per function
+#   truncation                -> reprlib cuts huge args down ("[1, 2, 3, 4, 5, 6, ...]")
+
+import io
+import itertools
+import logging
+import logging.handlers
+import queue
+import reprlib
+import sys
+import time
+from functools import wraps
+from threading import current_thread
+
+short = reprlib.Repr()
+short.maxstring = 60        # Strings longer than this get "..." in the middle
+short.maxother = 60
+short.maxlist = short.maxtuple = short.maxdict = short.maxset = 6
+
+class Short:
+    # Holds a value and only runs reprlib on it when logging calls str(), which is on the listener thread
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return short.repr(self.value)
+
+
+class TraceListener(logging.handlers.QueueListener):
+    # The caller only puts a plain tuple on the queue. Even building the LogRecord (timestamps, thread name,
+    # process id...) is surprisingly slow, so that's the listener thread's job too
+    def prepare(self, item):
+        created, thread, thread_name, level, name, msg, args = item
+        record = logging.LogRecord("trace", level, name, 0, msg, args, None, func=name)
+        record.created = created        # When it happened, not when the listener got to it
+        record.msecs = (created - int(created)) * 1000
+        record.thread = thread          # Who made the call, LogRecord would have filled in the listener thread
+        record.threadName = thread_name
+        return record
+
+
+class Tracer:
+    # Holds the queue + listener. Call start() once at startup and stop() at shutdown (stop flushes the queue)
+    # Catch: args are captured by reference, if the caller mutates them right after, the log shows the new value
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+
+    def start(self, *handlers):
+        self.listener = TraceListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        self.listener.stop()
+        self.listener = None
+
+    def enabled_for(self, level):
+        return self.listener is not None and level >= self.level
+
+TRACER = Tracer()
+
+
+# @log_calls or @log_calls(sample_rate=0.01, max_per_second=100)
+def log_calls(func=None, *, level=logging.DEBUG, sample_rate=1.0, max_per_second=None, tracer=TRACER):
+    if not 0 <= sample_rate <= 1:
+        raise ValueError(f"sample_rate must be between 0 and 1, got {sample_rate!r}")
+    if func is None:
+        return lambda f: log_calls(f, level=level, sample_rate=sample_rate, max_per_second=max_per_second, tracer=tracer)
+
+    name = func.__qualname__
+    put = tracer.queue.put
+    now = time.time
+    every = max(1, round(1 / sample_rate)) if sample_rate else 0      # 0 = sample_rate=0, never log
+    counter = itertools.count()
+    window = [0, 0]     # [which second, how many logged in it]. Not locked, so it's "about" max_per_second
+
+    def should_log():
+        if not every or not tracer.enabled_for(level):
+            return False
+        if every > 1 and next(counter) % every:
+            return False
+        if max_per_second is not None:
+            second = int(time.monotonic())
+            if window[0] != second:
+                window[0], window[1] = second, 0
+            if window[1] >= max_per_second:
+                return False
+            window[1] += 1
+        return True
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not should_log():
+            return func(*args, **kwargs)
+        # Raw values only. "%s" + Short() means the string gets built later, on the listener thread
+        thread = current_thread()
+        put((now(), thread.ident, thread.name, level, name, "Calling %s with args=%s, kwargs=%s", (name, Short(args), Short(kwargs))))
+        result = func(*args, **kwargs)
+        put((now(), thread.ident, thread.name, level, name, "%s returned %s", (name, Short(result))))
+        return result
+    return wrapper
+
+
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("[LOG] %(message)s"))
+TRACER.start(handler)
+
+@log_calls
+def add(a, b):
+    return a + b
+
+add(3, 5)
+add(list(range(100_000)), [])   # Would have printed 100k numbers before
+
+@log_calls(sample_rate=0)       # Off: never logged, even with tracing on
+def subtract(a, b):
+    return a - b
+
+subtract(3, 5)
+
+TRACER.stop()
+
+# Prints
+"""
+[LOG] Calling add with args=(3, 5), kwargs={}
+[LOG] add returned 8
+[LOG] Calling add with args=([0, 1, 2, 3, 4, 5, ...], []), kwargs={}
+[LOG] add returned [0, 1, 2, 3, 4, 5, ...]
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: cost per call seen by the CALLER, 100k calls, everything written to a StringIO
+    def print_log_calls(func):      # The original log_calls from above
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            print(f"[LOG] Calling {func.__name__} with args={args}, kwargs={kwargs}")
+            result = func(*args, **kwargs)
+            print(f"[LOG] {func.__name__} returned {result}")
+            return result
+        return wrapper
+
+    def work(patient_id, chart):
+        return len(chart)
+
+    chart = list(range(200))
+    sink = io.StringIO()
+    TRACER.start(logging.StreamHandler(sink))
+
+    versions = {
+        "no decorator": work,
+        "print f-strings": print_log_calls(work),
+        "queue, every call": log_calls(work),
+        "queue, 1% sampled": log_calls(work, sample_rate=0.01),
+        "queue, 1000/s cap": log_calls(work, max_per_second=1000),
+    }
+
+    for label, func in versions.items():
+        real_stdout, sys.stdout = sys.stdout, sink     # Same destination for print as for the listener
+        start = time.perf_counter()
+        for i in range(100_000):
+            func(i, chart)
+        elapsed = time.perf_counter() - start
+        sys.stdout = real_stdout
+        print(f"{label:<20}{elapsed / 100_000 * 1e9:8.0f} ns/call")
+
+    TRACER.level = logging.WARNING     # Tracing switched off, DEBUG is below the bar now
+    start = time.perf_counter()
+    for i in range(100_000):
+        versions["queue, every call"](i, chart)
+    print(f"{'queue, level off':<20}{(time.perf_counter() - start) / 100_000 * 1e9:8.0f} ns/call")
+    TRACER.stop()
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    no decorator             192 ns/call
+    print f-strings        30661 ns/call
+    queue, every call      10410 ns/call
+    queue, 1% sampled       1907 ns/call
+    queue, 1000/s cap       2472 ns/call
+    queue, level off        1490 ns/call
+    """
+    # That box only has 1 core, so "every call" still pays for the listener thread sharing the CPU
+    # With a spare core the listener's work comes off the caller's time completely
+
+# Great for leaving tracing on in production, EMR action audit trails, chatty automation flows
+
+
+
+
+
 # Timing
 
 import time
@@ -107,12 +331,265 @@ def slow():
 slow()
 
 # Prints
+"""
 slow took 1.00021 seconds
+"""
 
 # Great for profiling, optimizing loops, and checking on network/automation delays
 
 
 
+# Timing, the grown up version
+# The timed above prints on every single call. In a hot loop:
+#   print() is WAY slower than a tiny function, so we end up mostly measuring print
+#   the numbers scroll off the screen and are gone. No averages, no "how bad is the worst 1%"
+#
+# Instead: every timed function records into a histogram, and we ask for a report when we want one
+#
+# Log bucketed histogram:
+#   Instead of storing every duration (millions of floats), store counts in buckets that grow by 10% each
+#   bucket 100 = 1.1^100 seconds, bucket 101 = 1.1^101 seconds...
+#   A few hundred buckets cover nanoseconds to hours, and any percentile is off by at most ~5%
+#   Recording is just an append, the log()/bucket math happens 1024 samples at a time
+#
+# sample_rate: only time 1 out of every N calls. The other calls go straight through, nearly free
+# So it can stay on in production for functions called millions of times
+
+import csv
+import io
+import itertools
+import json
+import math
+import threading
+import time
+from collections import Counter, deque
+from contextlib import redirect_stdout
+from functools import wraps
+
+class Histogram:
+    GROWTH = 1.1
+    SCALE = 1 / math.log(GROWTH)
+    BATCH = 1024
+
+    def __init__(self, name, sample_rate=1.0):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.pending = deque()      # Raw durations waiting to be bucketed
+        self.buckets = Counter()    # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        # The hot path is just an append (deque.append is thread safe on its own, no lock needed)
+        # The math happens in batches of 1024 inside flush()
+        pending = self.pending
+        pending.append(seconds)
+        if len(pending) >= self.BATCH:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            popleft = self.pending.popleft
+            batch = [popleft() for _ in range(len(self.pending))]
+            if not batch:
+                return
+            # log(0) is an error, and a really fast call can measure as exactly 0 on a coarse clock
+            if 0.0 in batch:
+                batch = [seconds or 1e-9 for seconds in batch]
+            # Every step here is a C builtin mapped over the whole batch, no Python level work per sample
+            self.buckets.update(map(math.floor, map(self.SCALE.__mul__, map(math.log, batch))))
+            self.count += len(batch)
+            self.total += math.fsum(batch)
+            self.min = min(self.min, min(batch))
+            self.max = max(self.max, max(batch))
+
+    def percentile(self, p):
+        self.flush()
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = p * self.count
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    middle = self.GROWTH ** (index + 0.5)       # Middle of the bucket
+                    return min(self.max, max(self.min, middle))
+            return self.max
+
+    def summary(self):
+        self.flush()
+        return {
+            "name": self.name,
+            "count": self.count,
+            "est_calls": round(self.count / self.sample_rate) if self.sample_rate else 0,     # Sampled 1 in 10 -> about 10x the calls
+            "sum": self.total,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+            "p50": self.percentile(0.50),
+            "p90": self.percentile(0.90),
+            "p99": self.percentile(0.99),
+        }
+
+
+class MetricsRegistry:
+    FIELDS = ["name", "count", "est_calls", "sum", "min", "max", "p50", "p90", "p99"]
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name, sample_rate=1.0):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(name, sample_rate)
+            return self.histograms[name]
+
+    def report(self):
+        lines = [f"{'name':<20}{'count':>10}{'calls':>10}{'sum':>10}{'min':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"]
+        for h in self.histograms.values():
+            s = h.summary()
+            lines.append(f"{s['name']:<20}{s['count']:>10}{s['est_calls']:>10}{s['sum']:>9.3f}s"
+                         + "".join(f"{s[k] * 1e6:>8.1f}us" for k in ("min", "p50", "p90", "p99", "max")))
+        return "\n".join(lines)
+
+    def dump_json(self, path):
+        with open(path, "w") as f:
+            json.dump([h.summary() for h in self.histograms.values()], f, indent=2)
+
+    def dump_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(h.summary() for h in self.histograms.values())
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+METRICS = MetricsRegistry()     # Default registry, everything @timed lands here
+
+
+# @timed or @timed(sample_rate=0.01, name="...")
+def timed(func=None, *, sample_rate=1.0, name=None, registry=METRICS):
+    if not 0 <= sample_rate <= 1:
+        raise ValueError(f"sample_rate must be between 0 and 1, got {sample_rate!r}")
+    if func is None:
+        return lambda f: timed(f, sample_rate=sample_rate, name=name, registry=registry)
+
+    histogram = registry.histogram(name or func.__qualname__, sample_rate)
+    perf_counter = time.perf_counter        # Local name = one less global lookup per call
+
+    if sample_rate >= 1:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.record(perf_counter() - start)
+    elif sample_rate == 0:
+        # Timing switched off, every call goes straight through
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
+    else:
+        # Every Nth call instead of random.random(), a counter is cheaper and spreads samples out evenly
+        every = max(1, round(1 / sample_rate))
+        counter = itertools.count()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if next(counter) % every:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.record(perf_counter() - start)
+
+    wrapper.histogram = histogram
+    return wrapper
+
+
+@timed
+def slow():
+    time.sleep(0.01)
+
+for _ in range(20):
+    slow()
+
+@timed(sample_rate=0)        # Off: nothing gets timed
+def not_timed():
+    pass
+
+not_timed()
+
+print(METRICS.report())
+with tempfile.TemporaryDirectory() as folder:        # Somewhere to put the files, gone after the example
+    METRICS.dump_json(os.path.join(folder, "timings.json"))
+    METRICS.dump_csv(os.path.join(folder, "timings.csv"))
+    with open(os.path.join(folder, "timings.csv")) as f:
+        print(f.readline().strip())
+
+# Prints (something like)
+"""
+name                     count     calls       sum       min       p50       p90       p99       max
+slow                        20        20    0.207s 10078.6us 10078.6us 10810.5us 13080.8us 13226.9us
+not_timed                    0         0    0.000s     0.0us     0.0us     0.0us     0.0us     0.0us
+name,count,est_calls,sum,min,max,p50,p90,p99
+"""
+
+
+if RUN_BENCHMARKS:
+    # How much does timing cost per call? Tiny function, 200k calls
+    def add(a, b):
+        return a + b
+
+    def print_timed(func):      # The original timed from above
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            duration = time.perf_counter() - start
+            print(f"{func.__name__} took {duration:.5f} seconds")
+            return result
+        return wrapper
+
+    bench_registry = MetricsRegistry()
+    versions = {
+        "no decorator": add,
+        "print per call": print_timed(add),
+        "histogram": timed(add, name="add", registry=bench_registry),
+        "histogram 1%": timed(add, name="add_sampled", sample_rate=0.01, registry=bench_registry),
+    }
+
+    for label, func in versions.items():
+        with redirect_stdout(io.StringIO()):    # Throw the prints away, we only want the cost
+            start = time.perf_counter()
+            for i in range(200_000):
+                func(i, i)
+            elapsed = time.perf_counter() - start
+        print(f"{label:<16}{elapsed / 200_000 * 1e9:8.0f} ns/call")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    no decorator         285 ns/call
+    print per call      3258 ns/call
+    histogram           1525 ns/call
+    histogram 1%         550 ns/call
+    """
+    # And that's print going into a StringIO. Printing to a real terminal is a lot slower than that
+
+# Great for finding the slow step in an automation flow, keeping timing on in production, comparing before/after an optimization
+
+
+
+
+
 # Retry logic for automation
 
 from functools import wraps
@@ -137,20 +614,17 @@ def retry(times = 3, delay = 1):
 def flaky_operation():
     raise ValueError("Oops")
 
-flaky_operation()
+try:
+    flaky_operation()
+except Exception as e:
+    print(e)
 
 # Prints
 """
 Attempt 1/3 failed: Oops
 Attempt 2/3 failed: Oops
 Attempt 3/3 failed: Oops
-Traceback (most recent call last):
-  File "REDACTED FILE PATH BY POSSUM", line 23, in <module>
-    flaky_operation()
-    ~~~~~~~~~~~~~~~^^
-  File "REDACTED FILE PATH BY POSSUM", line 15, in wrapper
-    raise Exception(f"{func.__name__} failed after {times} attempts")
-Exception: flaky_operation failed after 3 attempts
+flaky_operation failed after 3 attempts
 """
 # Great for EMR Login Failures, Temporary Network Issues, Selenium/Playwright flaky steps, API calls
 
@@ -158,6 +632,513 @@ Exception: flaky_operation failed after 3 attempts
 
 
 
+# Retry, the grown up version
+# The retry above has a few problems once there's a real outage and a lot of workers:
+#   Fixed delay       -> every worker retries at the exact same moment, in lockstep, and hammers the endpoint together
+#   except Exception  -> retries things that will NEVER work (a typo, a PermissionError, a bad patient ID)
+#   No limit overall  -> 100 functions x 3 retries each = 300 extra requests into a server that's already down
+#   time.sleep        -> a thread sits there blocked doing nothing for the whole wait
+#
+# The fixes:
+#   Exponential backoff -> wait base, 2x base, 4x base, ... (capped), give the server room to recover
+#   Jitter              -> randomize the wait so workers spread out instead of stampeding together
+#                          "full"         = random between 0 and the exponential wait
+#                          "decorrelated" = random between base and 3x the LAST wait (AWS's favorite)
+#   retry_on            -> allow-list of exceptions worth retrying, anything else is raised immediately
+#   Retry budget        -> a token bucket shared by the whole process. Each retry spends a token, tokens refill slowly.
+#                          When it's empty, nobody retries, the errors just go up
+#   Circuit breaker     -> tracks the recent error rate. Past the threshold the circuit "opens" and calls fail
+#                          instantly without even trying. After reset_timeout it lets ONE probe call through (half open),
+#                          the probe succeeding closes it, the probe failing (with any exception) opens it right back up
+#   async               -> asyncio.sleep gives the event loop back while waiting, no thread is held
+
+import asyncio
+import concurrent.futures
+import inspect
+import random
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+class RetryError(Exception):
+    pass
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def backoff(attempt, base, cap, jitter="full", previous=None):
+    exponential = min(cap, base * 2 ** (attempt - 1))
+    if jitter == "full":
+        return random.uniform(0, exponential)
+    if jitter == "decorrelated":
+        return min(cap, random.uniform(base, (previous or base) * 3))
+    return exponential      # jitter=None, plain exponential
+
+
+class RetryBudget:
+    # Token bucket: holds up to `burst` tokens, refills `per_second` tokens every second
+    def __init__(self, per_second=1.0, burst=10):
+        self.per_second = per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def spend(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_second)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+RETRY_BUDGET = RetryBudget()    # One per process, every @retry shares it unless told otherwise
+
+
+class CircuitBreaker:
+    def __init__(self, failure_rate=0.5, window=20, min_calls=5, reset_timeout=30):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls              # Don't open on 1 failure out of 1 call
+        self.reset_timeout = reset_timeout
+        self.results = deque(maxlen=window)     # True/False for the last `window` calls, old ones fall off
+        self.opened_at = None                   # None = closed
+        self.probing = False                    # Half open and the one probe call is out
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def before_call(self):
+        # Returns True if this caller is the half open probe. Pass that back to record(), only the probe decides
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(f"Circuit open, failing fast for another {remaining:.1f}s")
+            if self.probing:
+                raise CircuitOpenError("Circuit half open, waiting on the probe call")
+            self.probing = True         # Set under the lock, so only one caller gets to be the probe
+            return True
+
+    def record(self, success, counts=True, probe=False):
+        # counts=False: an exception retry_on doesn't cover (a typo, a bad patient ID). That's not the service
+        # being down, so it doesn't count toward the failure rate. But a probe that hits one still failed
+        with self.lock:
+            if probe:                           # Half open, the probe decides
+                self.probing = False
+                if success:
+                    self.opened_at = None
+                    self.results.clear()
+                else:
+                    self.opened_at = time.monotonic()
+                return
+            if self.opened_at is not None:
+                # A call that started before the circuit opened, finishing late. It says nothing about
+                # how the service is doing NOW, so it can't close the circuit or push the reset back
+                return
+            if not counts:
+                return
+            self.results.append(success)
+            failures = self.results.count(False)
+            if len(self.results) >= self.min_calls and failures / len(self.results) >= self.failure_rate:
+                self.opened_at = time.monotonic()
+
+
+# Same call signature as the simple retry, everything new is keyword only
+def retry(times=3, delay=1, *, max_delay=30, jitter="full", retry_on=(Exception,), budget=RETRY_BUDGET, breaker=None):
+    def decorator(func):
+        # Shared by the sync and async wrappers: how long to wait before the next try, or None to give up
+        def next_wait(attempt, previous):
+            if attempt >= times:
+                return None
+            if budget is not None and not budget.spend():
+                print(f"Retry budget empty, not retrying {func.__name__}")
+                return None
+            return backoff(attempt, delay, max_delay, jitter, previous)
+
+        def failed(attempt, e, probe):
+            if breaker is not None:
+                breaker.record(False, probe=probe)
+            print(f"Attempt {attempt}/{times} failed: {e}")
+
+        def succeeded(probe):
+            if breaker is not None:
+                breaker.record(True, probe=probe)
+
+        def gave_up(probe):
+            if breaker is not None:
+                breaker.record(False, counts=False, probe=probe)
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                wait = None
+                for attempt in range(1, times + 1):
+                    probe = breaker.before_call() if breaker is not None else False
+                    try:
+                        result = await func(*args, **kwargs)
+                    except retry_on as e:
+                        failed(attempt, e, probe)
+                        wait = next_wait(attempt, wait)
+                        if wait is None:
+                            raise RetryError(f"{func.__name__} failed after {attempt} attempts") from e
+                        await asyncio.sleep(wait)
+                    except BaseException:
+                        gave_up(probe)
+                        raise
+                    else:
+                        succeeded(probe)
+                        return result
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                wait = None
+                for attempt in range(1, times + 1):
+                    probe = breaker.before_call() if breaker is not None else False
+                    try:
+                        result = func(*args, **kwargs)
+                    except retry_on as e:
+                        failed(attempt, e, probe)
+                        wait = next_wait(attempt, wait)
+                        if wait is None:
+                            raise RetryError(f"{func.__name__} failed after {attempt} attempts") from e
+                        time.sleep(wait)
+                    except BaseException:
+                        gave_up(probe)
+                        raise
+                    else:
+                        succeeded(probe)
+                        return result
+        return wrapper
+    return decorator
+
+
+# Only network-ish errors are worth retrying. A ValueError goes straight up on the first try
+@retry(times=4, delay=0.1, max_delay=2, jitter="decorrelated", retry_on=(ConnectionError, TimeoutError))
+def flaky_operation():
+    raise ConnectionError("EMR not responding")
+
+try:
+    flaky_operation()
+except RetryError as e:
+    print(f"{e} (cause: {e.__cause__!r})")
+
+# Prints
+"""
+Attempt 1/4 failed: EMR not responding
+Attempt 2/4 failed: EMR not responding
+Attempt 3/4 failed: EMR not responding
+Attempt 4/4 failed: EMR not responding
+flaky_operation failed after 4 attempts (cause: ConnectionError('EMR not responding'))
+"""
+
+
+# Circuit breaker: after 3 of the last 3 calls failed, stop even trying
+emr_breaker = CircuitBreaker(failure_rate=0.5, window=10, min_calls=3, reset_timeout=0.5)
+
+@retry(times=1, breaker=emr_breaker, retry_on=(ConnectionError,))
+def emr_login():
+    raise ConnectionError("EMR down")
+
+for _ in range(5):
+    try:
+        emr_login()
+    except (RetryError, CircuitOpenError) as e:
+        print(f"{type(e).__name__}: {e} [{emr_breaker.state}]")
+
+time.sleep(0.6)
+print(emr_breaker.state)
+
+# Prints
+"""
+Attempt 1/1 failed: EMR down
+RetryError: emr_login failed after 1 attempts [closed]
+Attempt 1/1 failed: EMR down
+RetryError: emr_login failed after 1 attempts [closed]
+Attempt 1/1 failed: EMR down
+RetryError: emr_login failed after 1 attempts [open]
+CircuitOpenError: Circuit open, failing fast for another 0.5s [open]
+CircuitOpenError: Circuit open, failing fast for another 0.5s [open]
+half_open
+"""
+
+# Half open lets exactly one probe through, the rest keep failing fast until it's done
+# This probe dies on a ValueError, not a ConnectionError, and that still counts as the probe failing
+@retry(times=1, breaker=emr_breaker, retry_on=(ConnectionError,))
+def emr_lookup(patient_id):
+    time.sleep(0.1)
+    raise ValueError(f"bad patient id {patient_id!r}")
+
+def try_lookup(patient_id):
+    try:
+        emr_lookup(patient_id)
+    except Exception as e:
+        return type(e).__name__
+
+with concurrent.futures.ThreadPoolExecutor(4) as pool:
+    print(sorted(pool.map(try_lookup, ["x1", "x2", "x3", "x4"])), emr_breaker.state)
+
+# Prints
+"""
+['CircuitOpenError', 'CircuitOpenError', 'CircuitOpenError', 'ValueError'] open
+"""
+
+
+# async: 20 tasks all waiting out their backoff at once, on ONE thread
+calls = 0
+
+@retry(times=3, delay=0.2, jitter=None, retry_on=(TimeoutError,), budget=None)
+async def fetch_labs(patient_id):
+    global calls
+    calls += 1
+    if calls <= 20:     # The first round of calls all time out
+        raise TimeoutError(f"labs for {patient_id} timed out")
+    return f"labs for {patient_id}"
+
+async def main():
+    start = time.perf_counter()
+    results = await asyncio.gather(*[fetch_labs(i) for i in range(20)])
+    print(f"{len(results)} results in {time.perf_counter() - start:.2f}s, threads in use: {threading.active_count()}")
+
+asyncio.run(main())
+
+# Prints (plus 20 "Attempt 1/3 failed" lines)
+"""
+20 results in 0.20s, threads in use: 1
+"""
+# 20 tasks x 0.2s of waiting still only took 0.2s, they all waited together
+
+# Great for EMR outages, rate limited API's, anything where a lot of workers hit the same thing at the same time
+
+
+
+
+
+# Hedged requests (cutting off the slow tail)
+# retry only helps when a call FAILS. A lot of EMR/API calls don't fail, they're just sometimes really slow
+# 95 calls take 10ms, 5 calls take 500ms -> the average looks fine, but p99 (the slowest 1%) is awful
+# and a batch of 100 calls is only as fast as its slowest one
+#
+# Hedging: start the call. If it hasn't come back by the time most calls normally finish (say the 95th percentile),
+# fire off a second identical call. Whichever comes back first wins, the other gets cancelled
+# The straggler was probably a bad connection or a busy server, the second try usually lands on a good one
+#
+# The "normal" time isn't hard coded, each hedged function keeps a window of its recent latencies
+# so the threshold follows the real numbers over time
+#
+# ONLY hedge things that are safe to run twice (reads, lookups). Never hedge "delete_patient" or "submit_claim"
+
+import asyncio
+import concurrent.futures
+import inspect
+import random
+import threading
+import time
+from collections import deque, namedtuple
+from functools import wraps
+
+HedgeInfo = namedtuple("HedgeInfo", ["calls", "hedges", "hedge_wins", "threshold"])
+
+class LatencyWindow:
+    # Last `size` latencies. Old ones fall off the front so the percentile tracks recent behavior
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def hedged(percentile=0.95, initial_delay=0.1, min_delay=0.001, min_samples=20, window=200, max_workers=16):
+    def decorator(func):
+        latencies = LatencyWindow(window)
+        stats = {"calls": 0, "hedges": 0, "hedge_wins": 0}
+        lock = threading.Lock()
+
+        def threshold():
+            # Until we've seen enough calls, a percentile is just noise, so use the starting guess
+            if len(latencies.samples) < min_samples:
+                return initial_delay
+            return max(min_delay, latencies.percentile(percentile))
+
+        def count(name):
+            with lock:
+                stats[name] += 1
+
+        def info():
+            return HedgeInfo(stats["calls"], stats["hedges"], stats["hedge_wins"], round(threshold(), 4))
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                count("calls")
+                start = time.perf_counter()
+                first = asyncio.ensure_future(func(*args, **kwargs))
+                pending = {first}
+                try:
+                    # If the caller gets cancelled during either wait, the finally still cancels our tasks,
+                    # instead of leaving them running with nobody to collect their result (or their exception)
+                    done, _ = await asyncio.wait({first}, timeout=threshold())
+                    if done:
+                        latencies.record(time.perf_counter() - start)
+                        return first.result()
+                    count("hedges")
+                    second = asyncio.ensure_future(func(*args, **kwargs))
+                    pending = {first, second}
+                    while pending:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            if task.exception() is None:    # First one that actually worked, not just first one back
+                                if task is second:
+                                    count("hedge_wins")
+                                latencies.record(time.perf_counter() - start)
+                                return task.result()
+                    return first.result()   # Both failed, raise the original attempt's error
+                finally:
+                    for task in pending:
+                        task.cancel()       # asyncio can really cancel the loser
+                        # If it had already failed, cancel() does nothing: look at its exception so asyncio
+                        # doesn't warn "Task exception was never retrieved" about a result we don't want
+                        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        else:
+            # A thread can't walk away from a call it's running, so both attempts go to pool threads and the caller
+            # just waits on whichever finishes first. Nothing ever sits in the pool's queue though: a call only goes
+            # to the pool if a thread is free right now (slots), so queue wait can't leak into the latencies,
+            # and a busy pool means no hedging, instead of doubling the work exactly when everything is slow
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"hedge-{func.__name__}")
+            slots = threading.BoundedSemaphore(max_workers)
+
+            def run(args, kwargs):
+                # Times the function itself, on the thread that runs it
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    latencies.record(time.perf_counter() - start)
+                    slots.release()
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                count("calls")
+                if not slots.acquire(blocking=False):
+                    # Every pool thread is busy. Run it right here on the caller's thread, no hedge
+                    start = time.perf_counter()
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        latencies.record(time.perf_counter() - start)
+                first = pool.submit(run, args, kwargs)
+                # wait() + done() instead of result(timeout=...): since 3.11 the "took too long" TimeoutError is the
+                # builtin one, so a call that itself raises TimeoutError (a socket timeout) would look like a slow call
+                concurrent.futures.wait([first], timeout=threshold())
+                if first.done():
+                    return first.result()
+                if not slots.acquire(blocking=False):
+                    return first.result()       # No spare thread for a hedge, just keep waiting on the first try
+                count("hedges")
+                second = pool.submit(run, args, kwargs)
+                pending = {first, second}
+                for future in concurrent.futures.as_completed(pending):
+                    pending.discard(future)
+                    if future.exception() is None:
+                        if future is second:
+                            count("hedge_wins")
+                        for loser in pending:
+                            if loser.cancel():  # Only works if the loser hasn't started yet, a running thread can't be stopped
+                                slots.release()
+                        return future.result()
+                return first.result()
+
+        wrapper.hedge_info = info
+        return wrapper
+    return decorator
+
+
+# A read that's usually 5ms but 1 in 20 times gets stuck for 200ms
+def sometimes_slow_lookup(patient_id):
+    time.sleep(0.2 if random.random() < 0.05 else 0.005)
+    return {"id": patient_id}
+
+hedged_lookup = hedged(percentile=0.9, initial_delay=0.02)(sometimes_slow_lookup)
+
+def measure(func, n=200):
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return f"p50={times[n // 2] * 1000:6.1f}ms  p99={times[int(n * 0.99)] * 1000:6.1f}ms  total={sum(times):.2f}s"
+
+random.seed(42)
+print("plain  ", measure(sometimes_slow_lookup))
+random.seed(42)
+print("hedged ", measure(hedged_lookup))
+print(hedged_lookup.hedge_info())
+
+# Prints (numbers from my machine, yours will differ)
+"""
+plain   p50=   5.1ms  p99= 200.8ms  total=3.04s
+hedged  p50=   5.3ms  p99=  26.6ms  total=1.25s
+HedgeInfo(calls=200, hedges=11, hedge_wins=10, threshold=0.007)
+"""
+# Same random stragglers both runs. Only 11 extra calls (5%) cut p99 by ~8x
+
+
+# Under load: 64 callers at once into a 16 thread pool, for a read that always takes 50ms
+# 16 calls get a pool thread, the other 48 run on their own threads with no hedge. Nobody waits in a queue,
+# so nothing looks slow that isn't, and a saturated pool doesn't get a second copy of every call piled on
+def steady_lookup(patient_id):
+    time.sleep(0.05)
+    return {"id": patient_id}
+
+hedged_steady = hedged()(steady_lookup)
+
+def burst(func, callers=64):
+    start_line = threading.Barrier(callers)
+    def call(i):
+        start_line.wait()
+        return func(i)
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(callers) as pool:
+        list(pool.map(call, range(callers)))
+    return f"{time.perf_counter() - start:.2f}s"
+
+print("plain  ", burst(steady_lookup))
+print("hedged ", burst(hedged_steady))
+print(hedged_steady.hedge_info())
+
+# Prints (numbers from my machine, yours will differ)
+"""
+plain   0.06s
+hedged  0.06s
+HedgeInfo(calls=64, hedges=0, hedge_wins=0, threshold=0.0506)
+"""
+
+# Great for slow-but-not-broken reads: EMR chart lookups, API GETs, anything idempotent where p99 matters
+
+
+
+
+
 # Access Control
 from functools import wraps
 
@@ -175,16 +1156,13 @@ def delete_patient(user, patient_id):
 
 user = {"name": "Alice", "is_admin": False}
 
-delete_patient(user, 123)
+try:
+    delete_patient(user, 123)
+except PermissionError as e:
+    print(f"PermissionError: {e}")
 
 # Prints
 """
-Traceback (most recent call last):
-  File "REDACTED FILE PATH BY POSSUM", line 17, in <module>
-    delete_patient(user, 123)
-    ~~~~~~~~~~~~~~^^^^^^^^^^^
-  File "REDACTED FILE PATH BY POSSUM", line 7, in wrapper
-    raise PermissionError("Admin privileges required")
 PermissionError: Admin privileges required
 """
 
@@ -194,6 +1172,179 @@ PermissionError: Admin privileges required
 
 
 
+# Access Control, in bulk
+# requires_admin is fine for one click in a UI. A purge job that calls delete_patient 300,000 times is different:
+#   every call goes through the wrapper, every call looks up the permission again, one ID at a time
+# The user isn't going to stop being an admin halfway through the loop, so check ONCE per batch
+#
+# Pieces:
+#   Policy table   -> role -> permissions ("nurse" can "patient.read", "admin" can everything)
+#   Compiled cache -> a user's roles get turned into one frozenset of permissions the first time we see that
+#                     combination of roles. After that a check is one set lookup
+#                     Changing what a role can do bumps a version number and throws the compiled cache away
+#   requires(perm) -> like requires_admin but for any permission, one ID per call works exactly like before
+#   .batch         -> func.batch(user, ids): a list/range/generator of IDs, authorized once, then run in chunks
+#                     Its own method on purpose. Guessing "iterable = batch" would turn a dict or a composite key
+#                     tuple that's really ONE argument into a loop over its pieces
+#   .bulk          -> optionally register a function that handles a whole chunk at once (one SQL DELETE ... IN (...))
+
+import itertools
+import threading
+import time
+from functools import wraps
+
+class Policy:
+    def __init__(self, role_permissions):
+        self.lock = threading.Lock()
+        self.roles = {role: set(perms) for role, perms in role_permissions.items()}
+        self.version = 0
+        self.compiled = {}      # frozenset of roles -> frozenset of permissions
+
+    def permissions_for(self, user):
+        roles = frozenset(user.get("roles", ())) | ({"admin"} if user.get("is_admin") else set())
+        perms = self.compiled.get(roles)
+        if perms is None:
+            with self.lock:
+                perms = frozenset().union(*(self.roles.get(role, ()) for role in roles))
+                self.compiled[roles] = perms
+        return perms
+
+    def check(self, user, permission):
+        if permission not in self.permissions_for(user):
+            raise PermissionError(f"{user.get('name', 'user')} is missing permission {permission!r}")
+
+    # Anything that changes a role wipes the compiled cache so nobody keeps a permission they just lost
+    def grant(self, role, permission):
+        with self.lock:
+            self.roles.setdefault(role, set()).add(permission)
+            self.invalidate()
+
+    def revoke(self, role, permission):
+        with self.lock:
+            self.roles.get(role, set()).discard(permission)
+            self.invalidate()
+
+    def invalidate(self):
+        self.version += 1
+        self.compiled = {}
+
+
+POLICY = Policy({
+    "admin": {"patient.read", "patient.delete"},
+    "nurse": {"patient.read"},
+})
+
+def chunked(iterable, size):
+    # Works on generators too, never builds the whole list of IDs
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def requires(permission, *, policy=POLICY, chunk_size=1000):
+    def decorator(func):
+        bulk_handler = None
+
+        def batch(user, ids, *args, **kwargs):
+            policy.check(user, permission)      # Once, for the whole batch
+            done = 0
+            for chunk in chunked(ids, chunk_size):
+                if bulk_handler is not None:
+                    bulk_handler(user, chunk, *args, **kwargs)
+                else:
+                    for item in chunk:
+                        func(user, item, *args, **kwargs)   # The real function, no wrapper in between
+                done += len(chunk)
+            return done
+
+        @wraps(func)
+        def wrapper(user, item, *args, **kwargs):
+            policy.check(user, permission)
+            return func(user, item, *args, **kwargs)
+
+        def bulk(handler):
+            nonlocal bulk_handler
+            bulk_handler = handler
+            return handler
+
+        wrapper.batch = batch
+        wrapper.bulk = bulk
+        return wrapper
+    return decorator
+
+
+deleted = []
+
+@requires("patient.delete")
+def delete_patient(user, patient_id):
+    deleted.append(patient_id)
+
+@delete_patient.bulk
+def delete_patients(user, patient_ids):
+    deleted.extend(patient_ids)      # Really this would be one DELETE ... WHERE id IN (...) per chunk
+
+admin = {"name": "Alice", "roles": ["nurse"], "is_admin": True}
+nurse = {"name": "Bob", "roles": ["nurse"]}
+
+delete_patient(admin, 123)                          # One ID, same as before
+print(delete_patient.batch(admin, range(1, 2501)))  # 2500 IDs, 3 chunks, 1 permission check
+
+try:
+    delete_patient.batch(nurse, [1, 2, 3])
+except PermissionError as e:
+    print(e)
+
+POLICY.grant("nurse", "patient.delete")             # Roles changed, compiled cache gets thrown out
+print(delete_patient.batch(nurse, [1, 2, 3]), POLICY.version)
+
+# Prints
+"""
+2500
+Bob is missing permission 'patient.delete'
+3 1
+"""
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: 300k deletes
+    def old_style(user, patient_id):
+        pass
+
+    old_delete = requires_admin(old_style)
+    new_delete = requires("patient.delete")(old_style)
+
+    ids = range(300_000)
+
+    start = time.perf_counter()
+    for patient_id in ids:
+        old_delete(admin, patient_id)
+    print(f"requires_admin, one call per ID   {time.perf_counter() - start:.3f}s")
+
+    start = time.perf_counter()
+    new_delete.batch(admin, ids)
+    print(f"requires, one batch               {time.perf_counter() - start:.3f}s")
+
+    @new_delete.bulk
+    def noop_bulk(user, patient_ids):
+        pass
+
+    start = time.perf_counter()
+    new_delete.batch(admin, ids)
+    print(f"requires, one batch + .bulk       {time.perf_counter() - start:.3f}s")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    requires_admin, one call per ID   0.195s
+    requires, one batch               0.083s
+    requires, one batch + .bulk       0.009s
+    """
+
+# Great for purge jobs, bulk chart updates, anything that loops a guarded action over a big list of IDs
+
+
+
+
+
 # Caching
 from functools import wraps
 
@@ -217,4 +1368,853 @@ fib(35)
 
 # Great for expensive calculations, repeated database queries, re-running automation steps, polling API's
 
+
+
+
+
+# Caching, the grown up version
+# The cached above has two problems once it runs in something long lived:
+#   1) cache = {} never forgets anything. A worker that runs for days grows until the OS kills it (OOM)
+#   2) It only keys on *args. Call fib(n=10) and it blows up, wrapper() doesn't take kwargs
+#
+# What we want instead:
+#   maxsize -> LRU (Least Recently Used) eviction. When it's full, drop whatever was touched longest ago
+#   ttl     -> every entry expires after ttl seconds, so stale query results don't live forever
+#   kwargs  -> part of the key, same as args
+#   a lock  -> so several threads can share one cache without corrupting it
+#   stats   -> cache_info() / cache_clear(), same idea as functools.lru_cache, so we can tune it under load
+
+import inspect
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize", "nbytes"])
+
+_MISSING = object()         # Sentinel, because None is a perfectly good cached value
+_KWD_MARK = (object(),)     # Separates args from kwargs inside the key so f(1, x=2) != f(1, "x", 2)
+
+def make_key(args, kwargs):
+    key = args
+    if kwargs:
+        key += _KWD_MARK + tuple(sorted(kwargs.items()))   # sorted so f(a=1, b=2) and f(b=2, a=1) match
+    return key
+
+
+class LRUCache:
+    # OrderedDict remembers insertion order and can move a key to the end in O(1)
+    # Front of the dict = oldest, end of the dict = most recently used
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize      # None = unbounded (same as the old cached)
+        self.ttl = ttl              # None = never expires
+        self.data = OrderedDict()   # key -> (value, expires_at, nbytes)
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+    def get(self, key, default=_MISSING):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None:
+                value, expires_at, _ = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self.data.move_to_end(key)      # Touched, so it's now the newest
+                    self.hits += 1
+                    return value
+                self._drop(key)                     # Expired, treat it like it was never there
+                self.evictions += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        # sys.getsizeof is shallow (a list reports its pointers, not its items), good enough to tune with
+        size = sys.getsizeof(value)
+        now = time.monotonic()
+        expires_at = now + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if key in self.data:
+                self._drop(key)
+            self.data[key] = (value, expires_at, size)
+            self.nbytes += size
+            while self.maxsize is not None and len(self.data) > self.maxsize:
+                self._drop(next(iter(self.data)))   # First key = least recently used
+                self.evictions += 1
+            if self.ttl is not None:
+                self._purge_expired(now)
+
+    def _purge_expired(self, now):
+        # get() only drops an expired key when that same key is asked for again. A key nobody asks for again
+        # would sit there forever, and with maxsize=None that's the same OOM as the old unbounded cache
+        # The front is the least recently used, so that's where expired entries pile up: drop from there until one is
+        # still good. A key with a hit moves to the end, and it's dropped once it works its way back to the front.
+        # Each key gets dropped once, so that's O(1) per set() on average
+        while self.data:
+            oldest = next(iter(self.data))
+            if self.data[oldest][1] > now:
+                break
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, _, size = self.data.pop(key)
+        self.nbytes -= size
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.data), self.nbytes)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = self.nbytes = 0
+
+
+# Works both as @cached and @cached(maxsize=..., ttl=...)
+# If it's used bare, Python hands us the function directly. If it's called with options, func is None
+# and we return a decorator that's waiting for the function
+# disk / version are for the second tier, see "Caching to disk" below
+# single_flight stops a thundering herd, see "Single flight" below. async def functions get an async wrapper
+def cached(func=None, *, maxsize=128, ttl=None, disk=None, version=0, single_flight=False):
+    if func is None:
+        return lambda f: cached(f, maxsize=maxsize, ttl=ttl, disk=disk, version=version, single_flight=single_flight)
+
+    cache = LRUCache(maxsize, ttl)
+    flight = SingleFlight() if single_flight else None
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    # The slow path: memory already missed. Lock is NOT held while func runs.
+    # Without single_flight two threads may both compute the same miss, but a slow call never blocks every other key
+    def compute(key, args, kwargs):
+        if disk is not None:
+            disk_key = disk.make_key(name, version, args, kwargs)
+            value = disk.get(disk_key)
+            if value is _MISSING:
+                value = func(*args, **kwargs)
+                disk.set(disk_key, value)
+        else:
+            value = func(*args, **kwargs)
+        cache.set(key, value)
+        return value
+
+    # Same thing, but func is a coroutine function so its result has to be awaited
+    # (the disk tier is plain sqlite3, so that part still blocks the event loop for a moment)
+    async def compute_async(key, args, kwargs):
+        if disk is not None:
+            disk_key = disk.make_key(name, version, args, kwargs)
+            value = disk.get(disk_key)
+            if value is _MISSING:
+                value = await func(*args, **kwargs)
+                disk.set(disk_key, value)
+        else:
+            value = await func(*args, **kwargs)
+        cache.set(key, value)
+        return value
+
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            value = cache.get(key)
+            if value is _MISSING:
+                if flight is not None:
+                    return await flight.do_async(key, compute_async, key, args, kwargs)
+                value = await compute_async(key, args, kwargs)
+            return value
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            value = cache.get(key)
+            if value is _MISSING:
+                if flight is not None:
+                    return flight.do(key, compute, key, args, kwargs)
+                value = compute(key, args, kwargs)
+            return value
+
+    wrapper.cache = cache
+    wrapper.cache_info = cache.info
+    wrapper.cache_clear = cache.clear
+    if flight is not None:
+        wrapper.flight_info = flight.info
+    return wrapper
+
+
+@cached
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+fib(35)
+print(fib.cache_info())
+
+# Prints
+# CacheInfo(hits=33, misses=36, evictions=0, maxsize=128, currsize=36, nbytes=1008)
+
+
+@cached(maxsize=2, ttl=0.5)
+def lookup_patient(patient_id, include_notes=False):
+    print(f"Querying patient {patient_id}")
+    return {"id": patient_id, "notes": [] if include_notes else None}
+
+lookup_patient(1)
+lookup_patient(1)                       # Hit, no query
+lookup_patient(1, include_notes=True)   # Different kwargs = different key
+lookup_patient(2)                       # Cache is full, patient 1 (no notes) gets evicted
+time.sleep(0.6)
+lookup_patient(2)                       # Expired, queried again. Patient 1 (with notes) expired too, so it's cleared out
+print(lookup_patient.cache_info())
+
+# Prints
+"""
+Querying patient 1
+Querying patient 1
+Querying patient 2
+Querying patient 2
+CacheInfo(hits=1, misses=4, evictions=3, maxsize=2, currsize=1, nbytes=184)
+"""
+
+lookup_patient.cache_clear()    # Wipe everything, stats included
+
+
+# ttl with no maxsize still doesn't grow forever: every set() clears out what has already expired
+@cached(maxsize=None, ttl=0.1)
+def lookup_visit(visit_id):
+    return {"id": visit_id}
+
+for visit_id in range(1000):
+    lookup_visit(visit_id)
+time.sleep(0.2)
+lookup_visit(1000)
+print(lookup_visit.cache_info().currsize)
+
+# Prints
+# 1
+
+# Great for long running workers, anything where the data can go stale, and tuning cache size with real numbers
+
+
+
+
+
+# Caching to disk (survives restarts)
+# Everything above lives in RAM, so every cron run starts cold and pays for every query again
+# Second tier: when memory misses, check a SQLite file before actually calling the function
+#   memory hit -> nanoseconds
+#   disk hit   -> a SELECT, way cheaper than the real query
+#   miss       -> call func, store in both
+#
+# Things a disk cache needs that a dict doesn't:
+#   Versioned keys  -> if the function changes (or the key format changes), old entries must stop matching
+#   Size cap        -> a file that grows forever is the same OOM problem, just on disk
+#   Multi process   -> several cron jobs can hit the same file. SQLite already does file locking,
+#                      WAL mode lets readers keep going while one process writes
+#   Stable keys     -> the key has to come out the same in every process. pickle of a set/frozenset follows the
+#                      set's iteration order, and that changes with PYTHONHASHSEED (random per process), so sets
+#                      and dicts get put in a fixed order before they're hashed
+#
+# Reads stay reads: a hit only writes its "last used" time if the stored one is more than touch_interval old,
+# so processes hitting the cache at the same time aren't all queued up on the one write lock
+# The total size lives in a one row table that triggers keep up to date, instead of a SUM() over every row per insert
+
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+
+def canonical(value):
+    # Every container becomes (type name, items in a fixed order). Tagging all of them means a tuple
+    # that happens to look like ("frozenset", [...]) can't collide with a real frozenset
+    if isinstance(value, (set, frozenset)):
+        return (type(value).__qualname__, sorted(pickle.dumps(canonical(item), protocol=4) for item in value))
+    if isinstance(value, dict):
+        return (type(value).__qualname__, sorted((pickle.dumps(canonical(k), protocol=4), canonical(v)) for k, v in value.items()))
+    if isinstance(value, (tuple, list)):
+        return (type(value).__qualname__, [canonical(item) for item in value])
+    return value
+
+
+class DiskCache:
+    SCHEMA_VERSION = 2      # Bump if the key/value format below ever changes, every old row stops matching
+
+    def __init__(self, path="cache.db", max_bytes=64 * 1024 * 1024, touch_interval=60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval    # LRU order is only accurate to this many seconds, plenty for a cache
+        self.local = threading.local()      # sqlite3 connections can't be shared between threads, one each
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, nbytes INTEGER, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 1), nbytes INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO totals SELECT 1, COALESCE(SUM(nbytes), 0) FROM entries")
+            conn.executescript("""
+                CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+                    UPDATE totals SET nbytes = nbytes + new.nbytes;
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE OF nbytes ON entries BEGIN
+                    UPDATE totals SET nbytes = nbytes + new.nbytes - old.nbytes;
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+                    UPDATE totals SET nbytes = nbytes - old.nbytes;
+                END;
+            """)
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # timeout = how long to wait on another process's write lock before giving up
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # It's a cache, losing the last write on power loss is fine
+            self.local.conn = conn
+        return conn
+
+    def make_key(self, name, version, args, kwargs):
+        # Hash of everything that makes a call unique. The hash keeps the primary key short and fixed size
+        raw = pickle.dumps(canonical((self.SCHEMA_VERSION, name, version, args, kwargs)), protocol=4)
+        return hashlib.sha256(raw).hexdigest()
+
+    def get(self, key, default=_MISSING):
+        conn = self.connect()
+        row = conn.execute("SELECT value, accessed FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        now = time.time()
+        if now - row[1] > self.touch_interval:
+            with conn:
+                conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        conn = self.connect()
+        with conn:      # One transaction: insert + trim happen together or not at all
+            # An upsert, not INSERT OR REPLACE: REPLACE's hidden delete doesn't fire the delete trigger
+            conn.execute("INSERT INTO entries VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                         "value = excluded.value, nbytes = excluded.nbytes, accessed = excluded.accessed",
+                         (key, blob, len(blob), time.time()))
+            total = conn.execute("SELECT nbytes FROM totals").fetchone()[0]
+            if total > self.max_bytes:
+                # Walk from least recently accessed and delete until we're under 90% of the cap,
+                # so the next few inserts don't each have to trim again
+                target = self.max_bytes * 0.9
+                while total > target:
+                    oldest = conn.execute("SELECT key, nbytes FROM entries ORDER BY accessed LIMIT 100").fetchall()
+                    if not oldest:
+                        break
+                    for old_key, nbytes in oldest:
+                        conn.execute("DELETE FROM entries WHERE key = ?", (old_key,))
+                        total -= nbytes
+                        if total <= target:
+                            break
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM entries")
+
+
+# cached (above) takes it as disk=..., version=... says "my function changed, ignore old results"
+
+if RUN_BENCHMARKS:
+    # Benchmark: cold, warm in memory, and warm on disk only (a brand new process), for fib and a slow lookup
+    disk = DiskCache(bench_path("cache.db"), max_bytes=8 * 1024 * 1024)
+    disk.clear()        # Start cold for the benchmark
+
+    @cached(maxsize=None, disk=disk)
+    def fib(n):
+        if n < 2:
+            return n
+        return fib(n - 1) + fib(n - 2)
+
+    @cached(maxsize=None, disk=disk, version=1)
+    def slow_query(patient_id):
+        time.sleep(0.02)    # Pretend this is a database round trip
+        return {"id": patient_id, "name": f"Patient {patient_id}"}
+
+    def run_query_batch():
+        for patient_id in range(50):
+            slow_query(patient_id)
+
+    def bench(label, func, *args):
+        start = time.perf_counter()
+        func(*args)
+        print(f"{label:<24}{(time.perf_counter() - start) * 1000:10.3f} ms")
+
+    bench("fib cold", fib, 300)
+    bench("fib memory warm", fib, 300)
+    fib.cache_clear()       # Same as a brand new process, RAM is empty but cache.db is not
+    bench("fib disk warm", fib, 300)
+
+    bench("query cold", run_query_batch)
+    bench("query memory warm", run_query_batch)
+    slow_query.cache_clear()
+    bench("query disk warm", run_query_batch)
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    fib cold                    31.230 ms
+    fib memory warm              0.005 ms
+    fib disk warm                0.100 ms
+    query cold                1043.271 ms
+    query memory warm            0.095 ms
+    query disk warm              2.797 ms
+    """
+
+    # fib is the worst case for the disk tier: the real math is cheaper than a SELECT, so cold is SLOWER than no cache
+    # slow_query is what it's actually for. Disk warm skips every sleep, a fresh cron run starts almost as fast as a warm one
+
+# Great for cron jobs, re-running automation steps after a crash, expensive API/database lookups that don't change often
+
+
+
+
+
+# Single flight (stopping the thundering herd)
+# Picture 50 threads all asking for the same patient at the same moment, cache is cold
+# Every one of them misses, every one of them runs the query. 50 identical queries, 49 wasted
+# That's a thundering herd
+#
+# Single flight fixes it: the FIRST caller for a key becomes the "leader" and actually runs the call
+# Everyone else who shows up for that key while it's running just waits on the leader's Future
+# and gets the exact same result (or the exact same exception)
+#
+# A Future is a box that will eventually hold a result. future.result() blocks until it's filled
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import namedtuple
+
+FlightInfo = namedtuple("FlightInfo", ["leaders", "coalesced", "in_flight"])
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}         # key -> Future of the call currently running for that key
+        self.leaders = 0        # Calls that actually ran
+        self.coalesced = 0      # Calls that piggybacked on a leader instead of running
+
+    def join(self, key, make_future):
+        # Returns (future, is_leader). Only this tiny bit needs the lock, never the call itself
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self.calls[key] = make_future()
+            self.leaders += 1
+            return future, True
+
+    def done(self, key):
+        with self.lock:
+            del self.calls[key]
+
+    def do(self, key, func, *args, **kwargs):
+        future, leader = self.join(key, concurrent.futures.Future)
+        if not leader:
+            return future.result()      # Blocks until the leader is done, re-raises its exception if it failed
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self.done(key)
+
+    async def do_async(self, key, func, *args, **kwargs):
+        # The call runs in its own task instead of inside the leader. If the leader gets cancelled (its own
+        # wait_for timeout, say), the call keeps going and the followers still get the result
+        # shield() means a cancelled caller, leader or follower, only stops waiting, it never cancels the call
+        loop = asyncio.get_running_loop()
+        task, leader = self.join(key, lambda: loop.create_task(func(*args, **kwargs)))
+        if leader:
+            task.add_done_callback(lambda finished: self.finished(key, finished))
+        return await asyncio.shield(task)
+
+    def finished(self, key, task):
+        self.done(key)
+        if not task.cancelled():
+            task.exception()        # Mark it as retrieved, otherwise asyncio warns when every caller gave up waiting
+
+    def info(self):
+        with self.lock:
+            return FlightInfo(self.leaders, self.coalesced, len(self.calls))
+
+
+# Threads
+query_count = 0
+
+@cached(ttl=60, single_flight=True)
+def load_patient(patient_id):
+    global query_count
+    query_count += 1
+    time.sleep(0.1)     # Slow query
+    return {"id": patient_id}
+
+start_line = threading.Barrier(50)      # Holds all 50 threads until they're ready, then releases them together
+
+def worker():
+    start_line.wait()
+    return load_patient(7)
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=50) as pool:
+    results = [f.result() for f in [pool.submit(worker) for _ in range(50)]]
+
+print(f"Queries run: {query_count}, same object every time: {all(r is results[0] for r in results)}")
+print(load_patient.flight_info())
+
+# Prints
+"""
+Queries run: 1, same object every time: True
+FlightInfo(leaders=1, coalesced=49, in_flight=0)
+"""
+
+
+# asyncio works the same way, just with an asyncio Future and await instead of blocking
+@cached(ttl=60, single_flight=True)
+async def fetch_chart(patient_id):
+    await asyncio.sleep(0.1)
+    raise TimeoutError(f"EMR timed out loading chart {patient_id}")
+
+async def main():
+    results = await asyncio.gather(*[fetch_chart(7) for _ in range(50)], return_exceptions=True)
+    print(f"Errors: {len(results)}, same exception every time: {all(r is results[0] for r in results)}")
+    print(fetch_chart.flight_info())
+
+asyncio.run(main())
+
+# Prints
+"""
+Errors: 50, same exception every time: True
+FlightInfo(leaders=1, coalesced=49, in_flight=0)
+"""
+
+
+# The leader timing out doesn't take the followers down with it, the call just carries on without it
+@cached(ttl=60, single_flight=True)
+async def fetch_allergies(patient_id):
+    await asyncio.sleep(0.1)
+    return ["penicillin"]
+
+async def impatient_leader():
+    return await asyncio.wait_for(fetch_allergies(7), timeout=0.05)
+
+async def main():
+    results = await asyncio.gather(impatient_leader(), *[fetch_allergies(7) for _ in range(3)], return_exceptions=True)
+    print([type(r).__name__ if isinstance(r, BaseException) else r for r in results])
+    print(fetch_allergies.flight_info())
+
+asyncio.run(main())
+
+# Prints
+"""
+['TimeoutError', ['penicillin'], ['penicillin'], ['penicillin']]
+FlightInfo(leaders=1, coalesced=3, in_flight=0)
+"""
+
+# Failures aren't cached, so the next call after the error is a fresh attempt (with a fresh leader)
+
+# Great for cold starts, cache expiring under heavy load, lots of workers polling the same API/EMR endpoint
+
+
+
+
+
+# Stacking decorators, and what it costs
+# Real functions end up with a stack like
+#
+#   @log_calls
+#   @timed
+#   @retry(times=3)
+#   @cached
+#   def load_chart(patient_id): ...
+#
+# Every layer is its own wrapper function. One call to load_chart is really 5 calls deep:
+#   log wrapper -> timed wrapper -> retry wrapper -> cached wrapper -> load_chart
+# and each hop is a new Python frame plus packing/unpacking *args and **kwargs again
+# In a tight loop that adds up to more than the function itself
+#
+# fused() builds ONE wrapper that does all of it: logging, timing, cache, retry, in a single frame
+# Same pieces as above (TRACER, METRICS, LRUCache, backoff, RETRY_BUDGET), just not nested
+# Order is the same as the stack above: log outermost, then timing, cache check, retry around the real call
+# (sync functions only, async functions still stack the normal decorators)
+
+import logging
+import time
+from functools import wraps
+from threading import current_thread
+
+def fused(*, log=False, timing=False, retry=None, cache=None, tracer=TRACER, registry=METRICS):
+    # retry = dict of the retry() options, ex. {"times": 3, "delay": 0.5, "retry_on": (ConnectionError,)}
+    # cache = dict of the cached() options, ex. {"maxsize": 1000, "ttl": 60}
+    retry = retry or {}
+    times = retry.get("times", 1)
+    delay = retry.get("delay", 1)
+    max_delay = retry.get("max_delay", 30)
+    jitter = retry.get("jitter", "full")
+    retry_on = retry.get("retry_on", (Exception,)) if times > 1 else ()     # except () catches nothing
+    budget = retry.get("budget", RETRY_BUDGET)
+
+    def decorator(func):
+        name = func.__qualname__
+        store = LRUCache(**cache) if cache is not None else None
+        histogram = registry.histogram(name) if timing else None
+        put = tracer.queue.put
+        perf_counter = time.perf_counter
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            tracing = log and tracer.enabled_for(logging.DEBUG)
+            if tracing:
+                thread = current_thread()
+                put((time.time(), thread.ident, thread.name, logging.DEBUG, name, "Calling %s with args=%s, kwargs=%s", (name, Short(args), Short(kwargs))))
+            if histogram is not None:
+                start = perf_counter()
+            try:
+                if store is not None:
+                    key = make_key(args, kwargs)
+                    result = store.get(key)
+                else:
+                    result = _MISSING
+                if result is _MISSING:
+                    attempt = 1
+                    wait = None
+                    while True:
+                        try:
+                            result = func(*args, **kwargs)
+                            break
+                        except retry_on as e:
+                            if tracing:
+                                put((time.time(), thread.ident, thread.name, logging.DEBUG, name, "Attempt %s/%s failed: %s", (attempt, times, e)))
+                            if attempt >= times or (budget is not None and not budget.spend()):
+                                raise RetryError(f"{name} failed after {attempt} attempts") from e
+                            wait = backoff(attempt, delay, max_delay, jitter, wait)
+                            time.sleep(wait)
+                            attempt += 1
+                    if store is not None:
+                        store.set(key, result)
+            finally:
+                if histogram is not None:
+                    histogram.record(perf_counter() - start)
+            if tracing:
+                put((time.time(), thread.ident, thread.name, logging.DEBUG, name, "%s returned %s", (name, Short(result))))
+            return result
+
+        if store is not None:
+            wrapper.cache_info = store.info
+            wrapper.cache_clear = store.clear
+        if histogram is not None:
+            wrapper.histogram = histogram
+        return wrapper
+    return decorator
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: per call cost of each decorator on its own, the full stack, and fused
+    # Tracing isn't started, so log_calls only pays for its "is tracing on?" check, same as in production with it off
+    # Same arguments every call, so cached is always a hit
+    def load_chart(patient_id):
+        return patient_id
+
+    bench_registry = MetricsRegistry()
+    versions = {
+        "bare function": load_chart,
+        "log_calls": log_calls(load_chart),
+        "timed": timed(load_chart, name="t1", registry=bench_registry),
+        "retry": retry(times=3)(load_chart),
+        "cached": cached(load_chart),
+        "stack of 2 (timed+cached)": timed(cached(load_chart), name="t2", registry=bench_registry),
+        "stack of 4": log_calls(timed(retry(times=3)(cached(load_chart)), name="t3", registry=bench_registry)),
+        "fused 2 (timed+cached)": fused(timing=True, cache={}, registry=bench_registry)(load_chart),
+        "fused 4": fused(log=True, timing=True, retry={"times": 3}, cache={}, registry=bench_registry)(load_chart),
+    }
+
+    N = 200_000
+    for label, func in versions.items():
+        start = time.perf_counter()
+        for _ in range(N):
+            func(7)
+        print(f"{label:<28}{(time.perf_counter() - start) / N * 1e9:8.0f} ns/call")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    bare function                    113 ns/call
+    log_calls                        532 ns/call
+    timed                            941 ns/call
+    retry                            537 ns/call
+    cached                           803 ns/call
+    stack of 2 (timed+cached)       2564 ns/call
+    stack of 4                      4010 ns/call
+    fused 2 (timed+cached)          2478 ns/call
+    fused 4                         2741 ns/call
+    """
+    # With only 2 layers fusing doesn't buy anything: fused 2 and stack of 2 swap places from run to run, within noise.
+    # The gain shows up as the stack grows. Stacked, every extra layer adds its own wrapper cost; fused 4 came in
+    # 1.3x-2x under stack of 4 on every run. The work itself is the same, the frames aren't
+
+# Great for hot loops that need logging/timing/caching anyway, and for checking what a decorator stack really costs
+
+
+
+
+
+# Deep recursion without the recursion limit
+# @cached fib(35) is fine. Cold fib(5000) is not:
+#   fib(5000) calls fib(4999) calls fib(4998)... 5000 calls deep before anything comes back
+#   Every level is 3 frames (wrapper, compute, fib), Python's limit is ~1000 frames -> RecursionError
+#   sys.setrecursionlimit(100_000) "works" until it segfaults because the C stack runs out
+#
+# Fix: don't let Python's call stack do the recursion. Keep our OWN stack in a list (lists can be huge)
+# The function is written as a generator, and instead of calling itself it YIELDS the arguments it needs:
+#
+#   normal:     return fib(n - 1) + fib(n - 2)
+#   generator:  return (yield n - 1) + (yield n - 2)
+#
+# The driver loop sees "I need fib(n - 1)", checks the cache, and if it's a miss it pushes a new generator onto
+# the list. When that one finishes, its result gets .send() back into the one that asked for it
+# This is called trampolining, the driver bounces between generators and the stack never gets deeper than 1 frame
+#
+# Multiple args: yield a tuple -> (yield (row - 1, col)). A single arg can be yielded bare
+# Keys are built with the same make_key as cached, so it can share a cache with a normal @cached function
+
+import functools
+import sys
+import time
+from functools import wraps
+
+def cached_recursive(func=None, *, maxsize=None, ttl=None, cache=None):
+    if func is None:
+        return lambda f: cached_recursive(f, maxsize=maxsize, ttl=ttl, cache=cache)
+
+    store = cache if cache is not None else LRUCache(maxsize, ttl)
+
+    @wraps(func)
+    def wrapper(*args):
+        key = make_key(args, {})
+        value = store.get(key)
+        if value is not _MISSING:
+            return value
+
+        get, put = store.get, store.set     # Looked up once, not on every trip around the loop
+        stack = [(key, func(*args))]        # (key, generator waiting on a sub result)
+        push, pop = stack.append, stack.pop
+        send = None                         # A brand new generator must be started with send(None)
+        while stack:
+            key, generator = stack[-1]
+            try:
+                request = generator.send(send)
+            except StopIteration as finished:
+                # This generator hit its return. Cache it and hand the value to whoever asked for it
+                pop()
+                send = finished.value
+                put(key, send)
+                continue
+            sub_args = request if type(request) is tuple else (request,)
+            sub_key = make_key(sub_args, {})
+            send = get(sub_key)
+            if send is _MISSING:
+                push((sub_key, func(*sub_args)))
+                send = None
+        return send
+
+    wrapper.cache = store
+    wrapper.cache_info = store.info
+    wrapper.cache_clear = store.clear
+    return wrapper
+
+
+@cached_recursive
+def deep_fib(n):
+    if n < 2:
+        return n
+    return (yield n - 1) + (yield n - 2)
+
+print(len(str(deep_fib(5000))), sys.getrecursionlimit())
+
+# Prints
+# 1045 1000
+# (fib(5000) has 1045 digits, and the recursion limit was never touched)
+
+
+# Sharing a cache: a normal @cached function and the generator version can use the same LRUCache
+@cached(maxsize=None)
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+@cached_recursive(cache=fib.cache)
+def fib_deep(n):
+    if n < 2:
+        return n
+    return (yield n - 1) + (yield n - 2)
+
+fib_deep(3000)      # Fills the shared cache bottom up, no recursion
+fib(3001)           # Normal version, one level deep then it hits what fib_deep already stored
+print(fib.cache_info())
+
+# Prints
+# CacheInfo(hits=3000, misses=3002, evictions=0, maxsize=None, currsize=3002, nbytes=494572)
+
+
+if RUN_BENCHMARKS:
+    # Benchmark: cold cache every run, fib(250) because @cached is 3 frames per level (wrapper, compute, fib)
+    # so ~300 is as deep as it can go
+    @functools.lru_cache(maxsize=None)
+    def lru_fib(n):
+        if n < 2:
+            return n
+        return lru_fib(n - 1) + lru_fib(n - 2)
+
+    @cached(maxsize=None)
+    def plain_fib(n):
+        if n < 2:
+            return n
+        return plain_fib(n - 1) + plain_fib(n - 2)
+
+    def bench(label, func, clear, n, runs=200):
+        start = time.perf_counter()
+        for _ in range(runs):
+            clear()
+            func(n)
+        print(f"{label:<28}{(time.perf_counter() - start) / runs * 1e6:10.1f} us")
+
+    bench("functools.lru_cache", lru_fib, lru_fib.cache_clear, 250)
+    bench("cached", plain_fib, plain_fib.cache_clear, 250)
+    bench("cached_recursive", deep_fib, deep_fib.cache_clear, 250)
+    bench("cached_recursive n=5000", deep_fib, deep_fib.cache_clear, 5000, runs=20)
+
+    try:
+        plain_fib.cache_clear()
+        plain_fib(5000)
+    except RecursionError:
+        print("cached n=5000               RecursionError")
+
+    # Prints (numbers from my machine, yours will differ)
+    """
+    functools.lru_cache               92.5 us
+    cached                           930.8 us
+    cached_recursive                1107.4 us
+    cached_recursive n=5000        22756.8 us
+    cached n=5000               RecursionError
+    """
+    # lru_cache is written in C so it wins at depths it can reach. cached and cached_recursive are about even
+    # (the generator round trips cost about what the wrapper/compute frames did, which one's ahead changes run to run),
+    # so the point of cached_recursive isn't speed: it's the only one that keeps going past the recursion limit
+
+# Great for deep recursive lookups (org charts, referral chains, dependency trees) where the input can get big
+
+
+
+
+
 # Validation
\ No newline at end of file